@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Startup benchmark for the ngutil command line. Times importing the package
+and building the NGUtil object, and checks that action handlers and heavy
+dependencies are not loaded before an action needs them.
+
+Usage: python bench/startup.py [--runs N] [--budget MS]
+"""
+import sys
+import argparse
+import subprocess
+from os import path
+
+# Modules that must only be imported on demand
+HEAVY = ['sqlite3', 'multiprocessing', 'tarfile', 'zipfile', 'urllib2', 'urllib.request', 'rpm', 'selinux',
+         'ngutil.site', 'ngutil.application', 'ngutil.source', 'ngutil.compress', 'ngutil.packages']
+
+# Run in a fresh interpreter, printing the elapsed time and any heavy modules loaded
+PROBE = """
+import sys, time
+start = time.time()
+import ngutil
+ngutil.NGUtil.__new__(ngutil.NGUtil)
+elapsed = (time.time() - start) * 1000
+print('{0:.2f} {1}'.format(elapsed, ','.join([m for m in %r if m in sys.modules])))
+""" % HEAVY
+
+def probe(root):
+    """
+    Time a single cold import of the package.
+    """
+    output  = subprocess.check_output([sys.executable, '-c', PROBE], cwd=root).decode('utf-8').split()
+    elapsed = float(output[0])
+    loaded  = output[1].split(',') if len(output) > 1 else []
+    return elapsed, loaded
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ngutil startup time')
+    parser.add_argument('--runs', type=int, default=20, help='Number of cold imports to time')
+    parser.add_argument('--budget', type=float, default=50.0, help='Median startup budget in milliseconds')
+    args = parser.parse_args()
+    root = path.dirname(path.dirname(path.abspath(__file__)))
+
+    # Collect timings
+    timings = []
+    loaded  = set()
+    for _ in range(args.runs):
+        elapsed, modules = probe(root)
+        timings.append(elapsed)
+        loaded.update(modules)
+    timings.sort()
+    median = timings[len(timings) // 2]
+    print('import ngutil: min={0:.2f}ms median={1:.2f}ms max={2:.2f}ms ({3} runs, budget {4:.0f}ms)'.format(
+        timings[0], median, timings[-1], args.runs, args.budget
+    ))
+
+    # Fail on eager imports or a blown budget
+    status = 0
+    if loaded:
+        print('Loaded at import: {0}'.format(', '.join(sorted(loaded))))
+        status = 1
+    if median > args.budget:
+        print('Median startup time exceeds budget of {0:.0f}ms'.format(args.budget))
+        status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
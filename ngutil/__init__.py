@@ -1,17 +1,15 @@
 import os
 import re
 import sys
+import json
 import argparse
-from platform import linux_distribution
 
 # Package version / root
 __version__ = '0.1-1'
 __root__    = os.path.abspath(os.path.dirname(__file__))
 
-# NGUtil Libraries
-from .site import _NGUtilSite
-from .common import _NGUtilCommon
-from .application import _NGUtilApp
+# NGUtil Libraries, action handlers are imported when first used
+from .common import _NGUtilCommon, _NGUtilLazy
 
 class _NGUtilArgs(_NGUtilCommon):
     """
@@ -24,6 +22,9 @@ class _NGUtilArgs(_NGUtilCommon):
         self.parser  = None
         self._args   = None
         
+        # Arguments which may be given more than once
+        self.multiple = ['backend', 'repo_sha256']
+        
         # Construct arguments
         self._construct()
         
@@ -42,11 +43,14 @@ class _NGUtilArgs(_NGUtilCommon):
         Return a formatted string of supported actions.
         """
         return(
-            'setup:        Setup  NGINX and PHP-FPM\n'
-            'create_site:  Create a new NGINX site definition\n'
-            'enable_site:  Link an available site in "/etc/nginx/sites-enabled"\n'
-            'disable_site: Remove a site from "/etc/nginx/sites-enabled"\n'
-            'list_sites:   List all managed sites'
+            'setup:         Setup  NGINX and PHP-FPM\n'
+            'create_site:   Create a new NGINX site definition\n'
+            'create_sites:  Create all NGINX site definitions in a JSON/YAML manifest\n'
+            'enable_site:   Link an available site in "/etc/nginx/sites-enabled"\n'
+            'disable_site:  Remove a site from "/etc/nginx/sites-enabled"\n'
+            'sync_site:     Sync updated source code into a new site release\n'
+            'compress_site: Precompress static assets and enable gzip_static for a site\n'
+            'list_sites:    List all managed sites'
         )
         
     def _construct(self):
@@ -63,8 +67,25 @@ class _NGUtilArgs(_NGUtilCommon):
         self.parser.add_argument('-s', '--ssl', help='Configure the site to use SSL', action='store_true')
         self.parser.add_argument('-C', '--ssl-cert', help='Location of the SSL certificate for the site', action='append')
         self.parser.add_argument('-K', '--ssl-key', help='Location of the SSL key for the site', action='append')
+        self.parser.add_argument('--ssl-chain', help='Location of the CA chain for the site, used to verify stapled OCSP responses', action='append')
         self.parser.add_argument('-f', '--force', help='Force a re-run of the initial setup utility', action='store_true')
         self.parser.add_argument('-S', '--source', help='Specify a local or remote location to retrieve the site code base', action='append')
+        self.parser.add_argument('-M', '--manifest', help='JSON/YAML manifest of sites to create', action='append')
+        self.parser.add_argument('--offline', help='Only use artifacts from the local download cache', action='store_true')
+        self.parser.add_argument('--repo-sha256', help='Pin a repository package to a SHA256 digest, i.e. "epel=<sha256>" (repeatable)', action='append')
+        self.parser.add_argument('--filter', help='Comma separated site filters: enabled, disabled, ssl, nossl or an FQDN pattern', action='append')
+        self.parser.add_argument('--limit', help='Maximum number of sites to list', type=int, action='append')
+        self.parser.add_argument('--offset', help='Number of sites to skip when listing', type=int, action='append')
+        self.parser.add_argument('--format', help='Site listing format: text, json (one object per line) or tsv', choices=['text', 'json', 'tsv'], action='append')
+        self.parser.add_argument('--fpm-pool', help='Create a dedicated PHP-FPM pool for the site on a unix socket', action='store_true')
+        self.parser.add_argument('--fpm-profile', help='PHP-FPM pool sizing profile: latency or density (default)', choices=['latency', 'density'], action='append')
+        self.parser.add_argument('--backend', help='FastCGI backend for the site upstream, i.e. "10.0.0.2:9000 weight=2 max_fails=3 fail_timeout=10s" (repeatable)', action='append')
+        self.parser.add_argument('--keepalive', help='Idle FastCGI connections kept open per NGINX worker, 0 to disable', type=int, action='append')
+        self.parser.add_argument('--static-profile', help='Static asset handling: default or performance (sendfile, gzip_static, fonts/svg/webp)', choices=['default', 'performance'], action='append')
+        self.parser.add_argument('--open-file-cache', help='Add an open_file_cache sized to the document root (performance profile)', action='store_true')
+        self.parser.add_argument('--microcache', help='Cache anonymous PHP responses for one second in a per-site FastCGI cache', action='store_true')
+        self.parser.add_argument('--checksum', help='Compare file contents as well as size/mtime when syncing a site', action='store_true')
+        self.parser.add_argument('--keep', help='Number of site releases to keep when syncing (default: 3)', type=int, action='append')
       
         # Parse CLI arguments
         sys.argv.pop(0)
@@ -84,13 +105,13 @@ class _NGUtilArgs(_NGUtilCommon):
         # Return all arguments
         if not k:
             _all_args = {}
-            for k,v in self._args.iteritems():
-                _all_args[k] = v if not isinstance(v, list) else v[0]
+            for k,v in self._args.items():
+                _all_args[k] = v if not isinstance(v, list) or k in self.multiple else v[0]
             return _all_args
         
         # Get the value from argparse
         _raw = self._args.get(k, default)
-        _val = _raw if not isinstance(_raw, list) else _raw[0]
+        _val = _raw if not isinstance(_raw, list) or k in self.multiple else _raw[0]
         
         # Return the value
         return _val if not use_json else json.dumps(_val)
@@ -105,12 +126,24 @@ class NGUtil(_NGUtilCommon):
         # Check effective user
         self._check_user()
         
-        # Application / site manager
-        self.app    = _NGUtilApp()
-        self.site   = _NGUtilSite()
-        
         # Create the argument handler
         self.args   = _NGUtilArgs(**kwargs)
+        
+    @_NGUtilLazy
+    def app(self):
+        """
+        Application manager, only needed for setup.
+        """
+        from .application import _NGUtilApp
+        return _NGUtilApp()
+        
+    @_NGUtilLazy
+    def site(self):
+        """
+        Site manager.
+        """
+        from .site import _NGUtilSite
+        return _NGUtilSite()
     
     def _check_support(self):
         """
@@ -123,8 +156,9 @@ class NGUtil(_NGUtilCommon):
         }
         
         # Get the current distro / major version
+        from platform import linux_distribution
         this_distro  = linux_distribution()[0].lower()
-        this_version = re.compile(r'(^[0-9]+)\..*$').sub(r'\g<1>', linux_distribution[1])
+        this_version = re.compile(r'(^[0-9]+)\..*$').sub(r'\g<1>', linux_distribution()[1])
     
         # Make sure the distribution is supported
         if not this_distro in supported:
@@ -147,11 +181,17 @@ class NGUtil(_NGUtilCommon):
         """
         self.site.create(self.args.get())
         
+    def create_sites(self):
+        """
+        Create NGINX sites in bulk from a manifest.
+        """
+        self.site.create_batch(self.args.get())
+        
     def list_sites(self):
         """
         List all managed NGINX sites.
         """
-        self.site.list_all()
+        self.site.list_all(self.args.get())
         
     def disable_site(self):
         """
@@ -165,6 +205,18 @@ class NGUtil(_NGUtilCommon):
         """
         self.site.enable(self.args.get())
         
+    def sync_site(self):
+        """
+        Sync source code into an NGINX site.
+        """
+        self.site.sync(self.args.get())
+        
+    def compress_site(self):
+        """
+        Precompress static assets for an NGINX site.
+        """
+        self.site.compress(self.args.get())
+        
     def setup(self):
         """
         Setup the NGINX server.
@@ -177,9 +229,12 @@ class NGUtil(_NGUtilCommon):
         """
         return {
             'create_site': self.create_site,
+            'create_sites': self.create_sites,
             'enable_site': self.enable_site,
             'disable_site': self.disable_site,
             'list_sites': self.list_sites,
+            'sync_site': self.sync_site,
+            'compress_site': self.compress_site,
             'setup': self.setup
         }
         
@@ -199,6 +254,10 @@ class NGUtil(_NGUtilCommon):
         # Run the action method
         mapper[action]()
         
+        # Run any queued service actions
+        from .service import service_queue
+        service_queue.flush()
+        
 def cli():
     """
     Entry point for running NGUtil from the command line.
@@ -1,19 +1,21 @@
+import re
 import sys
-import wget
 import shutil
-from os import path, unlink
-
-# RPM module
-try: 
-    import rpm
-except: 
-    pass
+from functools import partial
+from os import path
 
 # NGUtil Libraries
 from .service import _NGUtilService
 from .common import _NGUtilCommon, _NGUtilSELinux
 from .template import _NGUtilTemplates
+from .stage import _NGUtilStage
 from .iptables import _NGUtilIPTables
+from .tasks import _NGUtilTasks
+from .cache import _NGUtilCache
+from .packages import _NGUtilPackages
+from .tuning import _NGUtilTuning
+from .metadata import _NGUtilMetadata
+from .fpm import _NGUtilFPM
 
 class _NGUtilApp(_NGUtilCommon):
     """
@@ -25,29 +27,47 @@ class _NGUtilApp(_NGUtilCommon):
         # Passed arguments
         self.args     = None
      
-        # Deployment marker / template manager
+        # Deployment marker / template managers / NGINX config stage
         self.marker   = '/root/.ngutil/setup'
-        self.template = _NGUtilTemplates()
+        self.template = {
+            'NG_REPO':  _NGUtilTemplates(),
+            'NG_CONF':  _NGUtilTemplates(),
+            'FPM':      None
+        }
+        self.stage    = _NGUtilStage()
+        
+        # Hardware / cgroup aware service sizing
+        self.tuning   = _NGUtilTuning()
+        
+        # Services with changed configuration
+        self.changed  = {}
         
-        # Installed packages / additional repositories
+        # Installed packages (optionally with version constraints) / package planner / additional repositories
         self.packages = ['nginx', 'policycoreutils-python', 'php56u', 'php56u-fpm']
+        self.rpmdb    = _NGUtilPackages()
         self.repos    = {
             'epel': {
                 'config': '/etc/yum.repos.d/epel.repo',
-                'local': '/tmp/epel.rpm',
-                'upstream': 'http://dl.fedoraproject.org/pub/epel/6/x86_64/epel-release-6-8.noarch.rpm'
+                'package': 'epel-release',
+                'local': None,
+                'upstream': 'http://dl.fedoraproject.org/pub/epel/6/x86_64/epel-release-6-8.noarch.rpm',
+                'sha256': None,
+                'requires': []
             },
             'ius': {
                 'config': '/etc/yum.repos.d/ius.repo',
-                'local': '/tmp/ius.rpm',
-                'upstream': 'https://dl.iuscommunity.org/pub/ius/stable/CentOS/6/x86_64/ius-release-1.0-14.ius.centos6.noarch.rpm'
+                'package': 'ius-release',
+                'local': None,
+                'upstream': 'https://dl.iuscommunity.org/pub/ius/stable/CentOS/6/x86_64/ius-release-1.0-14.ius.centos6.noarch.rpm',
+                'sha256': None,
+                'requires': ['epel']
             }
         }
         
         # Controlled services
         self.service  = {
             'nginx':    _NGUtilService('nginx'),
-            'php-fpm':  _NGUtilService('php-fpm')
+            'php-fpm':  _NGUtilService('php-fpm', check=['php-fpm', '-t'])
         }
         
     def _config_firewall(self, rules):
@@ -64,20 +84,32 @@ class _NGUtilApp(_NGUtilCommon):
             iptables.select_chain(rule.get('chain', 'INPUT'))
             iptables.add_rule(rule.get('params'))
             
-        # Save the iptables config
-        iptables.save(restart=True)
+        # Apply and save the iptables config
+        iptables.save()
+        
+    def _render_phpfpm(self):
+        """
+        Render the PHP-FPM pool configuration.
+        """
+        
+        # Memory is shared with any dedicated site pools
+        fpm = _NGUtilFPM(_NGUtilMetadata(), self.tuning)
+        self.template['FPM'] = fpm.shared(fpm.count(), self.args.get('fpm_profile'))
+        self.template['FPM'].render()
         
     def _config_phpfpm(self):
         """
         Configuration steps for PHP-FPM.
         """
+        changed = False
         self.mkdir('/etc/php-fpm.d/disabled')
         if path.isfile('/etc/php-fpm.d/www.conf'):
             shutil.move('/etc/php-fpm.d/www.conf', '/etc/php-fpm.d/disabled/www.conf')
+            changed = True
         
         # Deploy the default pool configuration
-        self.template.setup('FPM', '/etc/php-fpm.d/pool.conf')
-        self.template.deploy(overwrite=True)
+        if self.template['FPM'].deploy(overwrite=True):
+            changed = True
         
         # Create pool log / session paths
         for dir in ['/srv/www/pool/logs/php-fpm', '/srv/www/pool/session']:
@@ -85,34 +117,27 @@ class _NGUtilApp(_NGUtilCommon):
             
         # Enable the port for SELinux
         # self.selinux.add_port(9000, 'tcp', 'http_port_t')
+        self.changed['php-fpm'] = changed
         self.feedback.success('Configured PHP-FPM')
         
-    def _config_nginx(self):
+    def _render_nginx(self):
         """
-        Generate the main NGINX configuration file.
+        Render the main NGINX configuration file.
         """
         
-        # Get the number of processers
-        exit_code, stdout, stderr = self.run_command('grep processor /proc/cpuinfo')
-        _WORKERPROCESSES = len(stdout.split('\n'))
-        
-        # Get system ulimit
-        exit_code, stdout, stderr = self.run_command('ulimit -n', shell=True)
-        _WORKERCONNECTION = stdout.rstrip()
+        # Setup the template
+        self.template['NG_CONF'].setup('NG_CONF', '/etc/nginx/nginx.conf')
+        self.template['NG_CONF'].setvars(self.tuning.nginx())
+        self.template['NG_CONF'].render()
         
-        # Make sure worker connections is a number
-        try:
-            _WORKERCONNECTION = str(int(_WORKERCONNECTION))
-        except:
-            _WORKERCONNECTION = '1024'
+    def _config_nginx(self):
+        """
+        Deploy the main NGINX configuration file.
+        """
+        self.template['NG_CONF'].deploy(overwrite=True, stage=self.stage)
         
-        # Setup the template
-        self.template.setup('NG_CONF', '/etc/nginx/nginx.conf')
-        self.template.setvars({
-            'WORKERPROCESSES':  _WORKERPROCESSES,
-            'WORKERCONNECTION': _WORKERCONNECTION
-        })
-        self.template.deploy(overwrite=True)
+        # Validate before going live
+        self.changed['nginx'] = self.stage.commit()
         
     def _convert_https(self, config):
         """
@@ -133,19 +158,21 @@ class _NGUtilApp(_NGUtilCommon):
         fh.write(_fixed)
         fh.close()
         
-    def _bar_none(self, current, total, width=80):
-        """
-        Supress wget output.
-        """
-        return False
-        
     def _preflight(self):
         """
         Preflight check before running setup.
         """
         
-        # SELinux manager
+        # SELinux manager / artifact cache
         self.selinux  = _NGUtilSELinux()
+        self.cache    = _NGUtilCache(offline=self.args.get('offline', False))
+        
+        # Repository package digests pinned on the command line
+        for pin in self.args.get('repo_sha256') or []:
+            repo, _, sha256 = pin.partition('=')
+            if not repo in self.repos or not re.match(r'^[0-9a-f]{64}$', sha256.lower()):
+                self.die('Invalid repository pin \'{0}\', must be one of \'{1}\' followed by \'=<sha256>\''.format(pin, '\', \''.join(sorted(self.repos))))
+            self.repos[repo]['sha256'] = sha256.lower()
         
         # Check if already setup
         if path.isfile(self.marker) and not self.args.get('force', False):
@@ -154,67 +181,88 @@ class _NGUtilApp(_NGUtilCommon):
         # Preflight checks complete
         self.feedback.info('Preparing to setup NGINX...')
         
-    def _install(self):
+    def _install_nginx_repo(self):
         """
-        Make sure NGINX is installed.
+        Add the NGINX repository.
         """
-        
-        # Add the NGINX repository
         nginx_repo = '/etc/yum.repos.d/nginx.repo'
         if not path.isfile(nginx_repo):
             self.feedback.info('Preparing to configure NGINX repository \'{0}\''.format(nginx_repo))
-            self.template.setup('NG_REPO', nginx_repo)
-            self.template.deploy()
+            self.template['NG_REPO'].setup('NG_REPO', nginx_repo)
+            self.template['NG_REPO'].deploy()
         else:
             self.feedback.info('NGINX repository \'{0}\' already exists, skipping...'.format(nginx_repo))
+            
+    def _fetch_repo(self, repo):
+        """
+        Download a repository package.
+        """
+        attrs = self.repos[repo]
         
-        # Download / install each repo
-        for repo, attrs in self.repos.iteritems():
+        # Only fetch if neither the repository package nor its configuration is present
+        if not self.rpmdb.satisfied(attrs['package']) and not path.isfile(attrs['config']):
+            attrs['local'] = self.cache.fetch(attrs['upstream'], sha256=attrs.get('sha256'))
+        else:
+            self.feedback.info('Repo provided by \'{0}\' already installed...'.format(attrs['upstream']))
             
-            # Only install if the repo configuration hasn't been created
-            if not path.isfile(attrs['config']):
-                wget.download(attrs['upstream'], out=attrs['local'], bar=self._bar_none)
-                self.feedback.success('Fetched repository package: {0} -> {1}'.format(attrs['upstream'], attrs['local']))
+    def _install_repo(self, repo):
+        """
+        Install a downloaded repository package.
+        """
+        attrs = self.repos[repo]
+        if not attrs['local']:
+            return
             
-                # Install the repository RPM
-                self.run_command('rpm -Uvh {0}'.format(attrs['local']))
-                self.feedback.success('Installed repository package: {0}'.format(attrs['local']))
-        
-                # WORKAROUND
-                # Can't access 'https' mirrors, so convert to 'http'
-                self._convert_https(attrs['config'])
-        
-                # Clean up the tmp package
-                unlink(attrs['local'])
-            else:
-                self.feedback.info('Repo provided by \'{0}\' already installed...'.format(attrs['upstream']))
+        # Check the package digests before installing, pinned packages were
+        # already verified against their SHA256
+        if not attrs.get('sha256'):
+            self.feedback.info('Repository package \'{0}\' is not pinned, checking RPM digests...'.format(attrs['package']))
+            self.run_command('rpm -K --nosignature {0}'.format(attrs['local']))
+        
+        # Install the repository RPM
+        self.run_command('rpm -Uvh {0}'.format(attrs['local']))
+        self.rpmdb.invalidate([attrs['package']])
+        self.feedback.success('Installed repository package: {0}'.format(attrs['local']))
+
+        # WORKAROUND
+        # Can't access 'https' mirrors, so convert to 'http'
+        self._convert_https(attrs['config'])
+        
+    def _install_packages(self):
+        """
+        Make sure NGINX and PHP-FPM are installed.
+        """
     
-        # Compile packages that need to be installed  
-        ts        = rpm.TransactionSet()
-        _packages = []
-        for pkg in self.packages:
-            pkg_obj = ts.dbMatch('name', pkg)
-            if pkg_obj.count() == 0:
-                _packages.append(pkg)
-                self.feedback.info('Marking package \'{0}\' for installation...'.format(pkg))
-            else:
-                self.feedback.info('Package \'{0}\' already installed, skipping...'.format(pkg))
-        
-        # If installing any packages
-        if _packages:
-            self.feedback.info('Preparing to install packages: {0}'.format(' '.join(_packages)))
+        # Compare all packages against the RPM database at once
+        plan = self.rpmdb.plan(self.packages)
+        
+        # If installing, updating or downgrading any packages
+        if plan['install'] or plan['update'] or plan['downgrade']:
+            for action in ['install', 'update', 'downgrade']:
+                if plan[action]:
+                    self.feedback.info('Preparing to {0} packages: {1}'.format(action, ' '.join(plan[action])))
+                    self.run_command('yum {0} {1} -y'.format(action, ' '.join(plan[action])), stdout=sys.stdout, stderr=sys.stderr)
             
-            # Install the packages
-            self.run_command('yum install {0} -y'.format(' '.join(_packages)), stdout=sys.stdout, stderr=sys.stderr)
+            # Make sure yum found versions matching every constraint
+            self.rpmdb.invalidate([self.rpmdb.parse(spec)[0] for spec in self.packages])
+            for spec in self.packages:
+                if not self.rpmdb.satisfied(spec):
+                    self.die('Package \'{0}\' not available from the configured repositories'.format(spec))
             self.feedback.success('Installed all packages!')
         else:
             self.feedback.info('All packages already installed...')
             
-        # Enable the services
+    def _enable_services(self):
+        """
+        Enable the services at boot.
+        """
         self.service['nginx'].enable()
         self.service['php-fpm'].enable()
         
-        # Make any required directories
+    def _create_dirs(self):
+        """
+        Make any required directories.
+        """
         for dir in [
             '/etc/nginx/sites-available',
             '/etc/nginx/sites-enabled',
@@ -222,30 +270,14 @@ class _NGUtilApp(_NGUtilCommon):
         ]:
             self.mkdir(dir)
             
-        # Configure NGINX and PHP-FPM
-        self._config_nginx()
-        self._config_phpfpm()
-        
-        # Start the services
-        self.service['php-fpm'].restart()
-        self.service['nginx'].restart()
-        
-        # Create the setup marker
-        self.mkfile(self.marker, contents='1', overwrite=True)
-        
-    def setup(self, args):
+    def _install(self):
         """
-        Launch the setup wizard for NGINX/PHP-FPM
+        Install and configure NGINX / PHP-FPM, running independent steps in parallel.
         """
-        
-        # Store arguments
-        self.args = args
-        
-        # Preflight checks
-        self._preflight()
+        tasks = _NGUtilTasks(threads=4)
         
         # Setup the firewall
-        self._config_firewall([
+        tasks.add('firewall', partial(self._config_firewall, [
             {
                 'chain': 'INPUT',
                 'params': {
@@ -264,7 +296,44 @@ class _NGUtilApp(_NGUtilCommon):
                     '-j': 'ACCEPT'
                 }
             }
-        ])
+        ]))
+        
+        # Repositories, downloads run in parallel and installs in dependency order
+        tasks.add('nginx_repo', self._install_nginx_repo)
+        for repo, attrs in self.repos.items():
+            tasks.add('fetch_{0}'.format(repo), partial(self._fetch_repo, repo))
+            tasks.add('install_{0}'.format(repo), partial(self._install_repo, repo),
+                ['fetch_{0}'.format(repo)] + ['install_{0}'.format(r) for r in attrs['requires']])
+        
+        # Packages / services / directories
+        tasks.add('packages', self._install_packages, ['nginx_repo'] + ['install_{0}'.format(r) for r in self.repos])
+        tasks.add('services', self._enable_services, ['packages'])
+        tasks.add('directories', self._create_dirs, ['packages'])
+        
+        # Configuration files are rendered up front and deployed once installed
+        tasks.add('render_nginx', self._render_nginx)
+        tasks.add('render_phpfpm', self._render_phpfpm)
+        tasks.add('config_nginx', self._config_nginx, ['render_nginx', 'directories'])
+        tasks.add('config_phpfpm', self._config_phpfpm, ['render_phpfpm', 'packages'])
+        tasks.run()
+        
+        # Start the services, only reloading if the configuration changed
+        self.service['php-fpm'].schedule('restart' if self.changed.get('php-fpm') else 'start')
+        self.service['nginx'].schedule('restart' if self.changed.get('nginx') else 'start')
+        
+        # Create the setup marker
+        self.mkfile(self.marker, contents='1', overwrite=True)
+        
+    def setup(self, args):
+        """
+        Launch the setup wizard for NGINX/PHP-FPM
+        """
+        
+        # Store arguments
+        self.args = args
+        
+        # Preflight checks
+        self._preflight()
         
         # Install required software
-        self._install()
\ No newline at end of file
+        self._install()
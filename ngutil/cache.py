@@ -0,0 +1,197 @@
+import json
+import time
+import hashlib
+import threading
+from tempfile import mkstemp
+from os import path, fdopen, unlink, makedirs, stat
+
+# Python 2/3 URL handling
+try:
+    from urllib2 import urlopen, Request, HTTPError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+# Atomic rename over an existing file
+try:
+    from os import replace
+except ImportError:
+    from os import rename as replace
+
+# NGUtil Libraries
+from .common import _NGUtilCommon
+
+class _NGUtilCache(_NGUtilCommon):
+    """
+    Class object for a content-addressed cache of downloaded artifacts.
+    """
+
+    # Serialize index updates between threads
+    _lock = threading.Lock()
+
+    # Verified objects by (path, size, mtime), shared for the whole run
+    _verified = {}
+
+    def __init__(self, root='/var/cache/ngutil', offline=False):
+        super(_NGUtilCache, self).__init__()
+
+        # Cache root / object store / URL index
+        self.root    = root
+        self.objects = '{0}/objects'.format(root)
+        self.index   = '{0}/index.json'.format(root)
+
+        # Only serve artifacts from the cache
+        self.offline = offline
+
+    def _load_index(self):
+        """
+        Load the URL -> artifact index.
+        """
+        if not path.isfile(self.index):
+            return {}
+        fh = open(self.index, 'r')
+        try:
+            return json.loads(fh.read())
+        except ValueError:
+            self.feedback.error('Invalid cache index \'{0}\', ignoring...'.format(self.index))
+            return {}
+        finally:
+            fh.close()
+
+    def _update_index(self, url, entry):
+        """
+        Update (or with no entry, remove) the index entry for a URL.
+        """
+        with self._lock:
+            index = self._load_index()
+            if entry:
+                index[url] = entry
+            else:
+                index.pop(url, None)
+            self.write_file(self.index, json.dumps(index, indent=2, sort_keys=True), mode=0o644)
+
+    def _object(self, sha256):
+        """
+        Path to a cached object.
+        """
+        return '{0}/{1}'.format(self.objects, sha256)
+
+    def _verify(self, _path, sha256):
+        """
+        Check a file matches an expected SHA256 digest. Files are only hashed
+        once per run unless they change.
+        """
+        try:
+            st = stat(_path)
+        except OSError:
+            return False
+        key = (_path, st.st_size, st.st_mtime)
+        if not key in self._verified:
+            self._verified[key] = self._hash_file(_path) == sha256
+        return self._verified[key]
+
+    def lookup(self, url, sha256=None):
+        """
+        Return the cached path for a URL, or None if not cached. Objects that
+        no longer match their content address are dropped from the cache.
+        """
+        entry = self._load_index().get(url)
+        if not entry or (sha256 and entry['sha256'] != sha256):
+            return None
+        cached = self._object(entry['sha256'])
+        if not path.isfile(cached):
+            return None
+        if not self._verify(cached, entry['sha256']):
+            self.feedback.error('Cached artifact \'{0}\' is corrupt, discarding...'.format(cached))
+            self._update_index(url, None)
+            unlink(cached)
+            return None
+        return cached
+
+    def open(self, url, headers=None):
+        """
+        Open a URL for reading.
+        """
+        return urlopen(Request(url, headers=headers or {}), timeout=60)
+
+    def fetch(self, url, sha256=None, chunk_size=65536):
+        """
+        Return a local path to the artifact at a URL, downloading it only if
+        it is not cached or has changed upstream.
+        """
+        entry  = self._load_index().get(url)
+        cached = self.lookup(url, sha256)
+
+        # Offline mode only serves from the cache
+        if self.offline:
+            if not cached:
+                self.die('Artifact \'{0}\' not available in cache \'{1}\' (offline mode)'.format(url, self.root))
+            self.feedback.info('Using cached artifact: {0} -> {1}'.format(url, cached))
+            return cached
+
+        # Pinned artifacts never need to be re-fetched
+        if cached and sha256:
+            self.feedback.info('Using cached artifact: {0} -> {1}'.format(url, cached))
+            return cached
+
+        # Conditional request against the cached (and verified) copy
+        headers = {}
+        if cached and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if cached and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = self.open(url, headers)
+        except HTTPError as e:
+            if e.code == 304 and cached:
+                self.feedback.info('Cached artifact up to date: {0} -> {1}'.format(url, cached))
+                return cached
+            self.die('Failed to fetch \'{0}\': {1}'.format(url, str(e)))
+        except Exception as e:
+            if cached:
+                self.feedback.error('Failed to check \'{0}\', using cached copy: {1}'.format(url, str(e)))
+                return cached
+            self.die('Failed to fetch \'{0}\': {1}'.format(url, str(e)))
+
+        # Stream the download to a temporary file, hashing as it arrives
+        try:
+            makedirs(self.objects)
+        except OSError:
+            pass
+        fd, tmp = mkstemp(dir=self.objects, prefix='.download.')
+        digest  = hashlib.sha256()
+        size    = 0
+        try:
+            fh = fdopen(fd, 'wb')
+            try:
+                for chunk in iter(lambda: response.read(chunk_size), b''):
+                    digest.update(chunk)
+                    fh.write(chunk)
+                    size += len(chunk)
+            finally:
+                fh.close()
+                response.close()
+
+            # Verify the checksum
+            if sha256 and digest.hexdigest() != sha256:
+                self.die('Checksum mismatch for \'{0}\': expected {1}, got {2}'.format(url, sha256, digest.hexdigest()))
+
+            # Store by content, already verified while downloading
+            replace(tmp, self._object(digest.hexdigest()))
+            st = stat(self._object(digest.hexdigest()))
+            self._verified[(self._object(digest.hexdigest()), st.st_size, st.st_mtime)] = True
+        finally:
+            if path.exists(tmp):
+                unlink(tmp)
+
+        # Record the artifact
+        info = response.info()
+        self._update_index(url, {
+            'sha256':        digest.hexdigest(),
+            'size':          size,
+            'etag':          info.get('ETag'),
+            'last_modified': info.get('Last-Modified'),
+            'fetched':       int(time.time())
+        })
+        self.feedback.success('Fetched artifact: {0} -> {1}'.format(url, self._object(digest.hexdigest())))
+        return self._object(digest.hexdigest())
@@ -1,21 +1,59 @@
+import hashlib
 from pwd import getpwnam
 from grp import getgrnam
 from sys import exit, stderr
 from feedback import Feedback
+from tempfile import mkstemp
 from subprocess import Popen, PIPE
-from os import path, makedirs, chown, listdir
+from stat import S_ISDIR, S_ISLNK
+from os import path, makedirs, chown, chmod, lchown, listdir, stat, lstat, unlink, fdopen, fsync, fchown, fchmod
+
+# Atomic rename over an existing file
+try:
+    from os import replace
+except ImportError:
+    from os import rename as replace
+
+# Directory scanning without a stat per name where available
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
 
 # ngutil
 from ngutil import __root__
 
+class _NGUtilLazy(object):
+    """
+    Descriptor creating an attribute the first time it is accessed.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.name    = factory.__name__
+        self.__doc__ = factory.__doc__
+        
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        
+        # Store on the instance, which takes precedence from now on
+        value = obj.__dict__[self.name] = self.factory(obj)
+        return value
+
 class _NGUtilCommon(object):
     """
     Common class for sharing methods and attributes between NGUtil classes.
     """
+    
+    # Feedback handler shared by all instances
+    _feedback = None
+    
     def __init__(self):
         
         # Feedback handler
-        self.feedback = Feedback(use_timestamp=True)
+        if _NGUtilCommon._feedback is None:
+            _NGUtilCommon._feedback = Feedback(use_timestamp=True)
+        self.feedback = _NGUtilCommon._feedback
         
         # Data directory
         self._DATA  = '{0}/data'.format(__root__)
@@ -23,6 +61,7 @@ class _NGUtilCommon(object):
         # Template ID / file mappings
         self._TEMPLATES = {
             'FPM':      self._data_map('fpm.conf.template'),
+            'FPM_SITE': self._data_map('site.fpm.conf'),
             'NG_REPO':  self._data_map('nginx.repo.template'),
             'NG_CONF':  self._data_map('nginx.conf.template'),
             'NG_HTTP':  self._data_map('site.http.conf'),
@@ -55,21 +94,79 @@ class _NGUtilCommon(object):
         if path.isfile(_path) and not overwrite:
             self.die('Cannot make file "{0}". Already exists and overwrite={1}'.format(_path, repr(overwrite)))
         
-        # Make sure the directory exists
-        self.mkpath(_path)
+        # Write the file
+        self.write_file(_path, contents or '')
+        
+        # Return the path
+        return _path
         
-        # Make the file
-        fh = open(_path, 'w')
+    def _hash_file(self, _path, chunk_size=65536):
+        """
+        Return the SHA256 digest of a file's contents.
+        """
+        digest = hashlib.sha256()
+        fh = open(_path, 'rb')
+        try:
+            for chunk in iter(lambda: fh.read(chunk_size), b''):
+                digest.update(chunk)
+        finally:
+            fh.close()
+        return digest.hexdigest()
         
-        # If writing contents
-        if contents:
-            fh.write(contents)
+    def write_file(self, _path, contents, owner=None, group=None, mode=0o644):
+        """
+        Atomically write a file if its contents have changed. Returns True if
+        the file was written, False if it was already up to date.
+        """
+        if not isinstance(contents, bytes):
+            contents = contents.encode('utf-8')
         
-        # Close the file
-        fh.close()
+        # Ownership: user / group default to the owner's primary group
+        uid = getpwnam(owner).pw_uid if owner else -1
+        gid = getgrnam(group).gr_gid if group else (getpwnam(owner).pw_gid if owner else -1)
         
-        # Return the path
-        return _path
+        # Make sure the directory exists
+        target_dir = path.dirname(_path)
+        if not path.isdir(target_dir):
+            makedirs(target_dir)
+            self.feedback.success('Created directory: {0}'.format(target_dir))
+        
+        # Compare with the existing file
+        if path.isfile(_path):
+            st = stat(_path)
+            if st.st_size == len(contents) and self._hash_file(_path) == hashlib.sha256(contents).hexdigest():
+                
+                # Fix ownership / permissions without rewriting
+                if (uid != -1 and st.st_uid != uid) or (gid != -1 and st.st_gid != gid):
+                    chown(_path, uid, gid)
+                if mode is not None and (st.st_mode & 0o7777) != mode:
+                    chmod(_path, mode)
+                return False
+        
+        # Write to a temporary file in the same directory
+        fd, tmp = mkstemp(dir=target_dir, prefix='.{0}.'.format(path.basename(_path)))
+        try:
+            fh = fdopen(fd, 'wb')
+            try:
+                fh.write(contents)
+                fh.flush()
+                fsync(fh.fileno())
+                
+                # Set ownership / permissions before the file is visible
+                if uid != -1 or gid != -1:
+                    fchown(fh.fileno(), uid, gid)
+                if mode is not None:
+                    fchmod(fh.fileno(), mode)
+            finally:
+                fh.close()
+            
+            # Swap in the new file
+            replace(tmp, _path)
+        except:
+            if path.exists(tmp):
+                unlink(tmp)
+            raise
+        return True
         
     def mkdir(self, dir):
         """
@@ -81,6 +178,85 @@ class _NGUtilCommon(object):
         else:
             self.feedback.info('Directory \'{0}\' already exists, skipping...'.format(dir))
         
+    def _scan(self, dir):
+        """
+        Return (path, lstat) pairs for each entry in a directory.
+        """
+        if scandir:
+            return [(entry.path, entry.stat(follow_symlinks=False)) for entry in scandir(dir)]
+        return [(path.join(dir, name), lstat(path.join(dir, name))) for name in listdir(dir)]
+        
+    def _set_entry_permissions(self, _path, st, uid, gid, mode, context, selinux):
+        """
+        Apply ownership / mode / SELinux context to a single entry if required.
+        Returns True if anything was changed.
+        """
+        changed = False
+        
+        # Ownership, never following symbolic links
+        if (uid != -1 and st.st_uid != uid) or (gid != -1 and st.st_gid != gid):
+            lchown(_path, uid, gid)
+            changed = True
+        
+        # Mode does not apply to symbolic links
+        if mode is not None and not S_ISLNK(st.st_mode) and (st.st_mode & 0o7777) != mode:
+            chmod(_path, mode)
+            changed = True
+            
+        # SELinux type
+        if context and selinux and selinux.gettype(_path) != context and selinux.settype(_path, context):
+            changed = True
+        return changed
+        
+    def set_permissions(self, root, owner=None, group=None, mode=None, context=None, selinux=None, threads=0):
+        """
+        Recursively apply ownership, mode and an optional SELinux type in a
+        single pass, skipping entries that are already correct. Directories
+        are processed in a thread pool when 'threads' is set.
+        """
+        uid = getpwnam(owner).pw_uid if owner else -1
+        gid = getgrnam(group).gr_gid if group else -1
+        if selinux and not selinux.enabled:
+            selinux = None
+        
+        # Totals of entries checked / changed
+        totals = {'checked': 1, 'changed': 0}
+        if self._set_entry_permissions(root, lstat(root), uid, gid, mode, context, selinux):
+            totals['changed'] += 1
+        
+        def _process(dir):
+            subdirs = []
+            checked = changed = 0
+            for _path, st in self._scan(dir):
+                checked += 1
+                if self._set_entry_permissions(_path, st, uid, gid, mode, context, selinux):
+                    changed += 1
+                if S_ISDIR(st.st_mode):
+                    subdirs.append(_path)
+            return subdirs, checked, changed
+        
+        # Walk the tree one level at a time, multiprocessing is only imported when threaded
+        pool = None
+        if threads and threads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(threads)
+        pending = [root] if S_ISDIR(lstat(root).st_mode) else []
+        try:
+            while pending:
+                results = pool.map(_process, pending) if pool else [_process(dir) for dir in pending]
+                pending = []
+                for subdirs, checked, changed in results:
+                    pending.extend(subdirs)
+                    totals['checked'] += checked
+                    totals['changed'] += changed
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            
+        self.feedback.success('Set permissions on \'{0}\': {1} checked, {2} changed'.format(root, totals['checked'], totals['changed']))
+        return totals
+        
     def run_command(self, cmd, expects=0, shell=False, stdout=PIPE, stderr=PIPE):
         """
         Run a shell command with Popen
@@ -132,11 +308,139 @@ class _NGUtilSELinux(_NGUtilCommon):
         except:
             self.feedback.info('SELinux not available on current system')
             self.enabled = False
+            
+        # Pending file context rules / port types
+        self._fcontexts = []
+        self._ports     = []
 
     def add_port(self, port, proto, context):
+        """
+        Queue a port type assignment, applied on commit.
+        """
         if self.enabled:
-            self.run_command('semanage port -a -t {0} -p {1} {2}'.format(context, proto, port), shell=True)
+            self._ports.append((str(port), proto, context))
+            
+    def add_fcontext(self, path, context, recursive=True):
+        """
+        Queue a persistent file context rule, applied on commit.
+        """
+        if self.enabled:
+            self._fcontexts.append(('{0}(/.*)?'.format(path) if recursive else path, context))
+            
+    def _existing_fcontexts(self):
+        """
+        Return locally defined file context rules as {spec: type}.
+        """
+        code, out, err = self.run_command(['semanage', 'fcontext', '-l', '-C'])
+        fcontexts = {}
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].startswith('/') and fields[-1].count(':') >= 3:
+                fcontexts[fields[0]] = fields[-1].split(':')[2]
+        return fcontexts
+        
+    def _existing_ports(self):
+        """
+        Return defined port types as {(proto, port): type}.
+        """
+        code, out, err = self.run_command(['semanage', 'port', '-l'])
+        ports = {}
+        for line in out.splitlines():
+            fields = line.split(None, 2)
+            if len(fields) < 3 or not fields[1] in ['tcp', 'udp']:
+                continue
+            for port in fields[2].split(','):
+                port = port.strip()
+                if port:
+                    ports.setdefault((fields[1], port), fields[0])
+        return ports
+        
+    def _port_type(self, ports, proto, port):
+        """
+        Find the type assigned to a port, including port ranges.
+        """
+        if (proto, port) in ports:
+            return ports[(proto, port)]
+        for (_proto, _port), context in ports.items():
+            if _proto == proto and '-' in _port:
+                low, high = _port.split('-', 1)
+                if int(low) <= int(port) <= int(high):
+                    return context
+        return None
+            
+    def commit(self):
+        """
+        Apply queued file context and port changes in a single 'semanage import'
+        transaction. Files are labeled when their permissions are set.
+        """
+        if not self.enabled:
+            return False
+        commands = []
+        
+        # File context rules not yet defined
+        if self._fcontexts:
+            existing = self._existing_fcontexts()
+            for spec, context in self._fcontexts:
+                if existing.get(spec) == context:
+                    continue
+                commands.append('fcontext -{0} -t {1} {2}'.format('m' if spec in existing else 'a', context, spec))
+                existing[spec] = context
+        
+        # Port types not yet assigned, ranges can only be overridden by adding the port
+        if self._ports:
+            existing = self._existing_ports()
+            for port, proto, context in self._ports:
+                current = self._port_type(existing, proto, port)
+                if current == context:
+                    continue
+                commands.append('port -{0} -t {1} -p {2} {3}'.format('m' if (proto, port) in existing else 'a', context, proto, port))
+                existing[(proto, port)] = context
+        
+        # Apply all policy changes at once
+        if commands:
+            proc = Popen(['semanage', 'import'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            out, err = proc.communicate('\n'.join(commands) + '\n')
+            if not proc.returncode == 0:
+                self.die('Failed to import SELinux policy changes: {0}'.format(err.rstrip()))
+            self.feedback.success('Imported {0} SELinux policy change(s)'.format(len(commands)))
+        else:
+            self.feedback.info('SELinux file contexts and ports already defined, skipping import...')
+        
+        # Clear the queues
+        self._fcontexts = []
+        self._ports     = []
+        return bool(commands)
 
     def chcon(self, path, context, recursive=False):
         if self.enabled:
-            self._selinux.chcon(path, context, recursive)
\ No newline at end of file
+            self._selinux.chcon(path, context, recursive)
+            
+    def gettype(self, path):
+        """
+        Return the SELinux type of a file without following links.
+        """
+        try:
+            return self._selinux.lgetfilecon(path)[1].split(':')[2]
+        except (OSError, IndexError):
+            return None
+            
+    def settype(self, path, context):
+        """
+        Set the SELinux type of a file without following links, keeping the
+        rest of its context. Returns True if the type was set.
+        """
+        
+        # Files without a readable label get the default user / role / level
+        try:
+            fields = self._selinux.lgetfilecon(path)[1].split(':')
+        except (OSError, IndexError):
+            fields = []
+        if len(fields) < 4:
+            fields = ['system_u', 'object_r', None, 's0']
+        fields[2] = context
+        try:
+            self._selinux.lsetfilecon(path, ':'.join(fields))
+            return True
+        except OSError as e:
+            self.feedback.error('Failed to set SELinux type \'{0}\' on \'{1}\': {2}'.format(context, path, str(e)))
+            return False
\ No newline at end of file
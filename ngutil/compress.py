@@ -0,0 +1,159 @@
+import io
+import os
+import gzip
+from multiprocessing import Pool
+from tempfile import mkstemp
+from os import path
+
+# Atomic rename over an existing file
+try:
+    from os import replace
+except ImportError:
+    from os import rename as replace
+
+# NGUtil Libraries
+from .common import _NGUtilCommon
+
+def _write_sibling(src, dst, data):
+    """
+    Atomically write a compressed sibling with the source's ownership, mode
+    and modification time.
+    """
+    st = os.stat(src)
+    fd, tmp = mkstemp(dir=path.dirname(dst), prefix='.ngutil.')
+    try:
+        fh = os.fdopen(fd, 'wb')
+        try:
+            fh.write(data)
+        finally:
+            fh.close()
+        os.chown(tmp, st.st_uid, st.st_gid)
+        os.chmod(tmp, st.st_mode & 0o7777)
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+        replace(tmp, dst)
+    finally:
+        if path.exists(tmp):
+            os.unlink(tmp)
+
+def _gzip(data, mtime):
+    """
+    Gzip data at maximum compression with a fixed header timestamp.
+    """
+    buf = io.BytesIO()
+    gz  = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf, mtime=mtime)
+    try:
+        gz.write(data)
+    finally:
+        gz.close()
+    return buf.getvalue()
+
+def _compress_file(job):
+    """
+    Write compressed siblings for a single file, run in a worker process.
+    Returns (path, siblings written, bytes saved, error).
+    """
+    src, formats = job
+    written = 0
+    saved   = 0
+    try:
+        fh = open(src, 'rb')
+        try:
+            data = fh.read()
+        finally:
+            fh.close()
+        for ext in formats:
+            compressed = _gzip(data, int(os.stat(src).st_mtime))
+
+            # Never serve a sibling larger than the original, nor an outdated one
+            if len(compressed) >= len(data):
+                if path.lexists('{0}.{1}'.format(src, ext)):
+                    os.unlink('{0}.{1}'.format(src, ext))
+                continue
+            _write_sibling(src, '{0}.{1}'.format(src, ext), compressed)
+            written += 1
+            saved   += len(data) - len(compressed)
+        return (src, written, saved, None)
+    except Exception as e:
+        return (src, written, saved, str(e))
+
+class _NGUtilCompress(_NGUtilCommon):
+    """
+    Class object for precompressing static assets in a document root.
+    """
+
+    # Compressible file extensions, images and fonts like woff are already compressed
+    EXTENSIONS = ('.html', '.htm', '.css', '.js', '.mjs', '.json', '.map', '.xml', '.txt', '.svg',
+                  '.ico', '.ttf', '.otf', '.eot', '.wasm', '.csv', '.md')
+
+    def __init__(self, processes=None, min_size=256):
+        super(_NGUtilCompress, self).__init__()
+
+        # Worker processes / smallest file worth compressing
+        self.processes = processes
+        self.min_size  = min_size
+
+        # Sibling formats, only those NGINX serves with gzip_static
+        self.formats = ['gz']
+
+    def _stale(self, src, st, ext):
+        """
+        Check if a compressed sibling is missing or older than its source.
+        """
+        try:
+            return os.stat('{0}.{1}'.format(src, ext)).st_mtime < st.st_mtime
+        except OSError:
+            return True
+
+    def _jobs(self, root):
+        """
+        Find files with missing or outdated compressed siblings.
+        """
+        jobs = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                if not name.lower().endswith(self.EXTENSIONS):
+                    continue
+                src = path.join(dirpath, name)
+                st  = os.lstat(src)
+                if path.islink(src):
+                    continue
+                formats = [ext for ext in self.formats if self._stale(src, st, ext)]
+
+                # Files too small to compress lose any outdated siblings
+                if st.st_size < self.min_size:
+                    for ext in formats:
+                        if path.lexists('{0}.{1}'.format(src, ext)):
+                            os.unlink('{0}.{1}'.format(src, ext))
+                    continue
+                if formats:
+                    jobs.append((src, formats))
+        return jobs
+
+    def run(self, root):
+        """
+        Compress every eligible file under a root in a process pool. Returns
+        the number of compressed siblings written.
+        """
+        jobs = self._jobs(root)
+        if not jobs:
+            self.feedback.info('All compressed assets up to date -> {0}'.format(root))
+            return 0
+
+        # Compress in parallel, files are independent
+        pool = Pool(self.processes)
+        try:
+            results = pool.map(_compress_file, jobs, chunksize=max(1, len(jobs) // ((self.processes or 1) * 8)))
+        finally:
+            pool.close()
+            pool.join()
+
+        # Report the results
+        written = 0
+        saved   = 0
+        for src, _written, _saved, error in results:
+            if error:
+                self.feedback.error('Failed to compress \'{0}\': {1}'.format(src, error))
+            written += _written
+            saved   += _saved
+        self.feedback.success('Compressed {0} file(s), wrote {1} sibling(s) saving {2}KB -> {3}'.format(len(jobs), written, saved // 1024, root))
+        return written
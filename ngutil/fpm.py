@@ -0,0 +1,105 @@
+from os import path
+
+# NGUtil Libraries
+from .common import _NGUtilCommon
+from .template import _NGUtilTemplates
+
+class _NGUtilFPM(_NGUtilCommon):
+    """
+    Class object for sizing the shared and per-site PHP-FPM pools together,
+    so their combined workers fit in memory.
+    """
+
+    # Shared pool created by setup
+    SHARED = '/etc/php-fpm.d/pool.conf'
+
+    def __init__(self, metadata, tuning):
+        super(_NGUtilFPM, self).__init__()
+
+        # Site metadata store / hardware tuning
+        self.metadata = metadata
+        self.tuning   = tuning
+
+        # Pool templates / site metadata waiting to be written
+        self._pending = []
+        self._updates = []
+
+    def site_pools(self, exclude=()):
+        """
+        Metadata of every site with a dedicated pool.
+        """
+        return [site for site in self.metadata.query() if (site.get('fpm') or {}).get('pool') and not site['fqdn'] in exclude]
+
+    def count(self, exclude=(), extra=0):
+        """
+        Number of pools sharing memory, the shared pool plus every site pool.
+        """
+        return 1 + len(self.site_pools(exclude)) + extra
+
+    def shared(self, pools, profile=None):
+        """
+        Template manager for the shared pool. The profile defaults to the one
+        chosen at setup.
+        """
+        profile = profile or self.metadata.setting('fpm_profile') or 'density'
+        self.metadata.set_setting('fpm_profile', profile)
+        template = _NGUtilTemplates()
+        template.setup('FPM', self.SHARED)
+        template.setvars(self.tuning.phpfpm(profile, pools=pools))
+        return template
+
+    def site(self, fqdn, socket, pools, profile=None):
+        """
+        Template manager for a site pool. Returns (template, max_children).
+        """
+        settings = self.tuning.phpfpm(profile or 'density', pools=pools)
+        template = _NGUtilTemplates()
+        template.setup('FPM_SITE', '/etc/php-fpm.d/{0}.conf'.format(fqdn))
+        template.setvars(settings)
+        template.setvars({
+            'SITENAME': fqdn,
+            'SOCKET': socket
+        })
+        return template, int(settings['PMMAXCHILDREN'])
+
+    def queue(self, template):
+        """
+        Queue a pool template to be written by apply(), rendering it now so
+        errors surface before anything changes.
+        """
+        template.render()
+        self._pending.append(template)
+
+    def resize(self, pools, exclude=()):
+        """
+        Queue the shared pool and every existing site pool sized for a number
+        of pools.
+        """
+        self.feedback.info('Sizing PHP-FPM pools for {0} pool(s)...'.format(pools))
+
+        # Shared pool, only once setup has created it
+        if path.isfile(self.SHARED):
+            self.queue(self.shared(pools))
+
+        # Site pools, remembering the new size for upstream keepalive limits
+        for site in self.site_pools(exclude):
+            template, max_children = self.site(site['fqdn'], site['fpm']['socket'], pools, site['fpm'].get('profile'))
+            self.queue(template)
+            if site['fpm'].get('max_children') != max_children:
+                site['fpm']['max_children'] = max_children
+                self._updates.append(site)
+
+    def apply(self):
+        """
+        Write the queued pools and their site metadata, once the rest of the
+        configuration has been accepted. Returns True if any pool changed.
+        """
+        changed = False
+        for template in self._pending:
+            changed = template.deploy(overwrite=True) or changed
+        with self.metadata.transaction():
+            for site in self._updates:
+                self.metadata.set(site, enabled=site['enabled'])
+        self._pending = []
+        self._updates = []
+        return changed
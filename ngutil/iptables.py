@@ -1,35 +1,185 @@
 from __future__ import unicode_literals
-import re
-import json
+import shlex
+from subprocess import Popen, PIPE
 
 # ngutil
 from ngutil.common import _NGUtilCommon
 
+class _NGUtilIPTablesRule(object):
+    """
+    Class object for a single tokenized iptables rule.
+    """
+
+    # Long option aliases
+    ALIASES = {
+        '--protocol':         '-p',
+        '--source':           '-s',
+        '--destination':      '-d',
+        '--in-interface':     '-i',
+        '--out-interface':    '-o',
+        '--jump':             '-j',
+        '--goto':             '-g',
+        '--destination-port': '--dport',
+        '--source-port':      '--sport',
+        '--ctstate':          '--state'
+    }
+
+    # Options for which the value order does not matter
+    UNORDERED = ['--state']
+
+    def __init__(self, table, chain, args):
+
+        # Table / chain / raw rule arguments
+        self.table = table
+        self.chain = chain
+        self.args  = list(args)
+
+        # Parsed options as (option, value, negated)
+        self.options = self._tokenize(self.args)
+
+        # Indexed fields
+        self.proto  = self.get('-p')
+        self.dport  = self.get('--dport')
+        self.sport  = self.get('--sport')
+        self.state  = self.get('--state')
+        self.target = self.get('-j')
+
+    @classmethod
+    def from_line(cls, table, line):
+        """
+        Create a rule from an 'iptables-save' line, i.e. '-A CHAIN ...'.
+        """
+        tokens = shlex.split(line)
+        return cls(table, tokens[1], tokens[2:])
+
+    @classmethod
+    def from_params(cls, table, chain, params):
+        """
+        Create a rule from a parameter mapping, i.e. {'-p': 'tcp', '-j': 'ACCEPT'}.
+        """
+
+        # Protocol first so protocol matches are loaded, target last
+        keys = sorted(params.keys(), key=lambda k: (0 if k == '-p' else (2 if k == '-j' else 1), k))
+        args = []
+        for k in keys:
+            args.extend(k.split() + [str(params[k])])
+        return cls(table, chain, args)
+
+    def _normalize(self, option, value):
+        """
+        Normalize an option value for comparison.
+        """
+        if option in self.UNORDERED:
+            return ','.join(sorted(value.split(',')))
+        if option in ['-s', '-d'] and value and not '/' in value:
+            return '{0}/32'.format(value)
+        return value
+
+    def _tokenize(self, args):
+        """
+        Split rule arguments into (option, value, negated) tuples.
+        """
+        options = []
+        negated = False
+        current = None
+        for token in args:
+
+            # Negation applies to the following option
+            if token == '!':
+                negated = True
+
+            # New option
+            elif token.startswith('-') and len(token) > 1:
+                if current:
+                    options.append(current)
+                name    = self.ALIASES.get(token, token)
+                current = (name, [], negated)
+                negated = False
+
+            # Option value
+            elif current:
+                current[1].append(token)
+        if current:
+            options.append(current)
+
+        # Join and normalize option values
+        return [(name, self._normalize(name, ' '.join(values)), negated) for name, values, negated in options]
+
+    def get(self, option):
+        """
+        Retrieve the value of an option.
+        """
+        for name, value, negated in self.options:
+            if name == option and not negated:
+                return value
+        return None
+
+    def key(self):
+        """
+        Index key for the rule.
+        """
+        return (self.table, self.chain, self.proto, self.dport, self.state, self.target)
+
+    def signature(self):
+        """
+        Canonical form of the full rule, ignoring match modules loaded only for
+        their options (i.e. '-m tcp' for '-p tcp').
+        """
+        implicit = [self.proto, 'state', 'conntrack']
+        return (self.table, self.chain, tuple(sorted([o for o in self.options if not (o[0] == '-m' and o[1] in implicit)])))
+
+    def format(self, action='-A', position=None):
+        """
+        Format the rule as an 'iptables-restore' line.
+        """
+        prefix = [action, self.chain] + ([str(position)] if position else [])
+        return ' '.join(prefix + [('"{0}"'.format(a) if ' ' in a else a) for a in self.args])
+
+    def is_catchall(self):
+        """
+        Check if the rule drops/rejects all remaining traffic in its chain.
+        """
+        return self.target in ['REJECT', 'DROP'] and not [o for o in self.options if not o[0] in ['-j', '--reject-with']]
+
+    def __str__(self):
+        return self.format()
+
 class _NGUtilIPTables(_NGUtilCommon):
     """
     Class for parsing and updating iptables firewall rules.
     """
     def __init__(self):
         super(_NGUtilIPTables, self).__init__()
-        
+
         # Firewall configuration
         self._config = '/etc/sysconfig/iptables'
-    
-        # Firewall tables / selected table
+
+        # Firewall tables / selected table / selected chain
         self._tables = {}
         self._table  = None
-    
+        self._chain  = None
+
+        # Table and chain order, as listed by iptables-save
+        self._order  = []
+        self._chains = {}
+
+        # Rules indexed by (table, chain, proto, dport, state, target)
+        self._index  = {}
+
+        # Pending 'iptables-restore' lines per table
+        self._pending = {}
+
         # Parse existing rules
         self._parse()
-    
+
     def select_table(self, name):
         """
         Select a table to modify chains/rules for.
         """
         if not name in self._tables:
-            self.die('Unable to locate table \'{0}\''.format(table))
+            self.die('Unable to locate table \'{0}\''.format(name))
         self._table = name
-    
+
     def select_chain(self, name):
         """
         Select a chain to modify rules for.
@@ -37,22 +187,33 @@ class _NGUtilIPTables(_NGUtilCommon):
         if not name in self._tables[self._table]:
             self.die('Unable to locate chain \'{0}\' in table \'{1}\''.format(name, self._table))
         self._chain = name
-    
-    def add_chain(self, name, target='ACCEPT'):
+
+    def add_chain(self, name):
         """
         Add a new firewall chain.
         """
         if not self._table:
             self.die('Cannot add chain \'{0}\', no table selected...'.format(name))
-        
+
         # Check if the chain exists
         if name in self._tables[self._table]:
             self.die('Unable to add chain \'{0}\' to table \'{1}\', already exists'.format(name, self._table))
-    
-        # Add the chain
-        self.run_command('iptables -t {0} -N {1} -j {2}'.format(table, name, target))
-        self.feedback.success('Added chain \'{0}\' to table \'{1}\' with target: {2}'.format(name, self._table, target))
-    
+
+        # Queue the chain
+        self._add_chain_to_model(self._table, name, '-')
+        self._pending.setdefault(self._table, []).append(':{0} - [0:0]'.format(name))
+        self.feedback.success('Added chain \'{0}\' to table \'{1}\''.format(name, self._table))
+
+    def has_rule(self, rule):
+        """
+        Check if an identical rule already exists.
+        """
+        signature = rule.signature()
+        for existing in self._index.get(rule.key(), []):
+            if existing.signature() == signature:
+                return True
+        return False
+
     def add_rule(self, params):
         """
         Add a rule to a table chain.
@@ -61,92 +222,144 @@ class _NGUtilIPTables(_NGUtilCommon):
             self.die('Cannot add iptables rule, no table selected')
         if not self._chain:
             self.die('Cannot add iptables rule, no chain selected')
-            
+
         # Make sure the rule doesn't exist yet
-        for rule in self._tables[self._table][self._chain]['rules']:
-            if rule.get('--dport', False) and rule['--dport'] == params.get('--dport', None):
-                return self.feedback.info('Rule matching --dport {0} already exists, skipping...'.format(params.get('--dport')))
-            
-        # Define the rule creation command
-        proto_cmd = '-p {0} --dport {1}'.format(params.get('-p', 'tcp'), params.get('--dport'))
-        state_cmd = '-m state --state {0} -j {1}'.format(params.get('-m state --state', 'NEW'), params.get('-j', 'ACCEPT'))
-        rule_cmd  = 'iptables -t {0} -A {1} {2} {3}'.format(self._table, self._chain, proto_cmd, state_cmd)
-        
-        # Create the rule
-        self.run_command(rule_cmd, shell=True)
-        self.feedback.success('Added iptables rule: \'{0}\''.format(rule_cmd))
-    
-        # Reparse the configuration
-        self._parse()
-    
+        rule = _NGUtilIPTablesRule.from_params(self._table, self._chain, params)
+        if self.has_rule(rule):
+            return self.feedback.info('Rule \'{0}\' already exists in table \'{1}\', skipping...'.format(str(rule), self._table))
+
+        # Add the rule ahead of any catch-all REJECT/DROP, applied on commit
+        position = self._add_to_model(rule)
+        if position:
+            self._pending.setdefault(self._table, []).append(rule.format('-I', position))
+        else:
+            self._pending.setdefault(self._table, []).append(rule.format('-A'))
+        self.feedback.success('Queued iptables rule: \'{0}\''.format(str(rule)))
+
     def get_table(self, name):
         """
         Retrieve table attributes.
         """
-        return self._tables.get('name', None)
-    
-    def _get_iptables_param(self, param, line):
+        return self._tables.get(name, None)
+
+    def _add_chain_to_model(self, table, name, target):
         """
-        Parse out a parameter from an iptables rule line.
+        Add a chain to a table.
         """
-        if '{0} '.format(param) in line:
-            return re.compile(r'^.*{0}[ ]([^ ]+).*$'.format(param)).sub(r'\g<1>', line).rstrip()
-        return None
-    
+        if not table in self._tables:
+            self._tables[table] = {}
+            self._chains[table] = []
+            self._order.append(table)
+        self._tables[table][name] = {
+            'target': target,
+            'rules':  []
+        }
+        self._chains[table].append(name)
+
+    def _add_to_model(self, rule, append=False):
+        """
+        Add a rule to its chain and the rule index. New rules go before any
+        catch-all REJECT/DROP rule, returning the 1-based insert position, or
+        None when the rule was appended.
+        """
+        rules    = self._tables[rule.table][rule.chain]['rules']
+        position = None
+        if not append:
+            for i, existing in enumerate(rules):
+                if existing.is_catchall():
+                    position = i + 1
+                    break
+        if position:
+            rules.insert(position - 1, rule)
+        else:
+            rules.append(rule)
+        self._index.setdefault(rule.key(), []).append(rule)
+        return position
+
     def _parse(self):
         """
         Parse existing iptables rules.
         """
-        
+
         # Parse existing rules
         code, out, err = self.run_command('iptables-save')
-        
-        # Current table
-        this_table = None
-        
+
+        # Reset the in-memory rules
+        self._tables  = {}
+        self._order   = []
+        self._chains  = {}
+        self._index   = {}
+        self._pending = {}
+        this_table    = None
+
         # Parse rules in memory
-        for line in out.split('\n'):
-            
+        for line in out.splitlines():
+            line = line.strip()
+
             # Parse out the current table
             if line.startswith('*'):
-                this_table = re.compile(r'^\*(.*$)').sub(r'\g<1>', line).rstrip()
+                this_table = line[1:]
                 self._tables[this_table] = {}
-                
+                self._chains[this_table] = []
+                self._order.append(this_table)
+
             # Parse the current chain
-            if line.startswith(':'):
-                regex = re.compile(r'^:([^ ]+)[ ]+([^ ]+).*$')
-                
-                # Chain attributes
-                chain_name   = regex.sub(r'\g<1>', line).rstrip()
-                chain_target = regex.sub(r'\g<2>', line).rstrip()
-                
-                # Extract chain attributes
-                self._tables[this_table][chain_name] = {
-                    'target': chain_target,
-                    'rules':  []
-                }
-                
+            elif line.startswith(':'):
+                fields = line[1:].split()
+                self._add_chain_to_model(this_table, fields[0], fields[1] if len(fields) > 1 else '-')
+
             # Parse the current rule
-            if line.startswith('-A'):
-                rule_chain  = self._get_iptables_param('-A', line)
-                self._tables[this_table][rule_chain]['rules'].append({
-                    '--dport': self._get_iptables_param('--dport', line),
-                    '--sport': self._get_iptables_param('--sport', line),
-                    '--state': self._get_iptables_param('--state', line),
-                    '-j': self._get_iptables_param('-j', line),
-                    '-p': self._get_iptables_param('-p', line),
-                    '-s': self._get_iptables_param('-s', line),
-                    '-d': self._get_iptables_param('-d', line)
-                })
-    
-    def save(self, restart=False):
-        """
-        Save and optionally restart iptables.
-        """
-        self.run_command('iptables-save > {0}'.format(self._config), shell=True)
-        self.feedback.success('Saved iptables rules -> {0}'.format(self._config))
-        
-        # If restarting
-        if restart:
-            self.run_command('service iptables restart', shell=True)
-            self.feedback.success('Restarted iptables')
\ No newline at end of file
+            elif line.startswith('-A'):
+                self._add_to_model(_NGUtilIPTablesRule.from_line(this_table, line), append=True)
+
+    def _render(self):
+        """
+        Render the in-memory rules in 'iptables-save' format.
+        """
+        lines = ['# Generated by ngutil']
+        for table in self._order:
+            lines.append('*{0}'.format(table))
+            for chain in self._chains[table]:
+                lines.append(':{0} {1} [0:0]'.format(chain, self._tables[table][chain]['target']))
+            for chain in self._chains[table]:
+                for rule in self._tables[table][chain]['rules']:
+                    lines.append(rule.format())
+            lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+    def commit(self):
+        """
+        Apply all queued chains and rules in a single 'iptables-restore --noflush'
+        transaction. Returns True if any changes were applied.
+        """
+        if not self._pending:
+            self.feedback.info('No iptables changes queued, skipping...')
+            return False
+
+        # Build the restore transaction
+        lines = []
+        for table in self._order:
+            if table in self._pending:
+                lines.append('*{0}'.format(table))
+                lines.extend(self._pending[table])
+                lines.append('COMMIT')
+
+        # Apply the changes
+        proc = Popen(['iptables-restore', '--noflush'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        out, err = proc.communicate('\n'.join(lines) + '\n')
+        if not proc.returncode == 0:
+            self.die('Failed to apply iptables rules: {0}'.format(err.rstrip()))
+        self.feedback.success('Applied {0} iptables change(s)'.format(sum([len(v) for v in self._pending.values()])))
+        self._pending = {}
+        return True
+
+    def save(self):
+        """
+        Apply queued changes and atomically write the rules to the iptables
+        configuration, without restarting the iptables service.
+        """
+        self.commit()
+        if self.write_file(self._config, self._render(), owner='root', mode=0o600):
+            self.feedback.success('Saved iptables rules -> {0}'.format(self._config))
+        else:
+            self.feedback.info('iptables rules unchanged -> {0}'.format(self._config))
@@ -0,0 +1,231 @@
+import json
+import sqlite3
+from os import path, listdir, makedirs
+
+# NGUtil Libraries
+from .common import _NGUtilCommon
+
+class _NGUtilMetadata(_NGUtilCommon):
+    """
+    Class object for storing and querying site metadata in SQLite.
+    """
+    def __init__(self, database='/root/.ngutil/metadata.db', legacy='/root/.ngutil/metadata', stream=None):
+        super(_NGUtilMetadata, self).__init__()
+
+        # Database file / legacy JSON metadata directory
+        self.database = database
+        self.legacy   = legacy
+
+        # Stream for status messages, instead of the feedback handler
+        self.stream   = stream
+
+        # Database connection / open transactions
+        self._conn    = None
+        self._depth   = 0
+
+    def _connect(self):
+        """
+        Open the metadata database, creating the schema if required.
+        """
+        if self._conn:
+            return self._conn
+
+        # Make sure the database directory exists, quietly as listings may be
+        # read by other programs
+        if not path.isdir(path.dirname(self.database)):
+            makedirs(path.dirname(self.database))
+
+        # Open the database
+        self._conn = sqlite3.connect(self.database)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sites (
+                fqdn      TEXT PRIMARY KEY,
+                enabled   INTEGER NOT NULL DEFAULT 0,
+                ssl       INTEGER NOT NULL DEFAULT 0,
+                metadata  TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sites_enabled ON sites (enabled, fqdn);
+            CREATE INDEX IF NOT EXISTS sites_ssl ON sites (ssl, fqdn);
+            CREATE TABLE IF NOT EXISTS settings (
+                key       TEXT PRIMARY KEY,
+                value     TEXT
+            );
+        """)
+
+        # Import any legacy JSON metadata
+        self._import_json()
+        return self._conn
+
+    def _import_json(self):
+        """
+        One-time import of legacy per-site JSON metadata files.
+        """
+        if self._conn.execute('SELECT 1 FROM settings WHERE key = ?', ('json_imported',)).fetchone():
+            return False
+
+        # Import each metadata file in a single transaction
+        imported = 0
+        with self.transaction():
+            if path.isdir(self.legacy):
+                for file in listdir(self.legacy):
+                    if not file.endswith('.json'):
+                        continue
+                    fh = open('{0}/{1}'.format(self.legacy, file), 'r')
+                    try:
+                        metadata = json.loads(fh.read())
+                    except ValueError:
+                        self.feedback.error('Skipping invalid metadata file: {0}/{1}'.format(self.legacy, file))
+                        continue
+                    finally:
+                        fh.close()
+
+                    # Enabled state is stored rather than checked on every listing
+                    self.set(metadata, enabled=path.isfile(metadata['config']['enabled']))
+                    imported += 1
+            self._conn.execute('INSERT INTO settings (key, value) VALUES (?, ?)', ('json_imported', str(imported)))
+
+        # Legacy metadata imported
+        if imported:
+            self._status('Imported {0} site metadata file(s) from: {1}'.format(imported, self.legacy))
+        return True
+
+    def _status(self, msg):
+        """
+        Report a status message, on the configured stream if set.
+        """
+        if self.stream:
+            self.stream.write('{0}\n'.format(msg))
+        else:
+            self.feedback.success(msg)
+
+    def transaction(self):
+        """
+        Return a context manager grouping writes into a single transaction.
+        """
+        return _NGUtilMetadataTransaction(self)
+
+    def _begin(self):
+        self._depth += 1
+
+    def _end(self, commit=True):
+        self._depth -= 1
+        if self._depth == 0:
+            if commit:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+
+    def _write(self, query, params):
+        """
+        Run a write query, committing unless inside a transaction.
+        """
+        with self.transaction():
+            return self._connect().execute(query, params)
+
+    def _row(self, row):
+        """
+        Convert a database row to a metadata dictionary.
+        """
+        metadata = json.loads(row['metadata'])
+        metadata['enabled'] = bool(row['enabled'])
+        return metadata
+
+    def set(self, metadata, enabled=False):
+        """
+        Create or update the metadata for a site.
+        """
+        self._write('INSERT OR REPLACE INTO sites (fqdn, enabled, ssl, metadata) VALUES (?, ?, ?, ?)', (
+            metadata['fqdn'],
+            1 if enabled else 0,
+            1 if metadata['ssl']['enable'] else 0,
+            json.dumps(metadata)
+        ))
+
+    def set_enabled(self, fqdn, enabled):
+        """
+        Update the enabled state for a site.
+        """
+        return self._write('UPDATE sites SET enabled = ? WHERE fqdn = ?', (1 if enabled else 0, fqdn)).rowcount > 0
+
+    def get(self, fqdn):
+        """
+        Retrieve the metadata for a single site.
+        """
+        row = self._connect().execute('SELECT * FROM sites WHERE fqdn = ?', (fqdn,)).fetchone()
+        return self._row(row) if row else None
+
+    def delete(self, fqdn):
+        """
+        Remove the metadata for a site.
+        """
+        return self._write('DELETE FROM sites WHERE fqdn = ?', (fqdn,)).rowcount > 0
+
+    def setting(self, key, default=None):
+        """
+        Retrieve a stored setting.
+        """
+        row = self._connect().execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else default
+
+    def set_setting(self, key, value):
+        """
+        Create or update a stored setting.
+        """
+        self._write('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+
+    def query(self, enabled=None, ssl=None, fqdn=None, limit=None, offset=None):
+        """
+        Generator yielding site metadata, optionally filtered.
+        """
+        where  = []
+        params = []
+
+        # Enabled / SSL state
+        if enabled is not None:
+            where.append('enabled = ?')
+            params.append(1 if enabled else 0)
+        if ssl is not None:
+            where.append('ssl = ?')
+            params.append(1 if ssl else 0)
+
+        # Shell style pattern on the FQDN
+        if fqdn:
+            where.append('fqdn GLOB ?')
+            params.append(fqdn)
+
+        # Build the query
+        query = 'SELECT * FROM sites{0} ORDER BY fqdn'.format(' WHERE {0}'.format(' AND '.join(where)) if where else '')
+        
+        # Pagination
+        if limit is not None or offset:
+            query += ' LIMIT ? OFFSET ?'
+            params.extend([-1 if limit is None else int(limit), int(offset or 0)])
+        
+        # Run the query
+        for row in self._connect().execute(query, params):
+            yield self._row(row)
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+class _NGUtilMetadataTransaction(object):
+    """
+    Context manager for grouping metadata writes.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store._connect()
+        self.store._begin()
+        return self.store
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.store._end(commit=(exc_type is None))
+        return False
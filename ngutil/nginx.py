@@ -0,0 +1,138 @@
+import re
+import json
+from os import path, environ, stat, access, X_OK
+from subprocess import Popen, PIPE
+
+# NGUtil Libraries
+from .common import _NGUtilCommon
+
+class _NGUtilNginx(_NGUtilCommon):
+    """
+    Class object for detecting the installed NGINX version and modules.
+    """
+
+    # Parsed 'nginx -V' output by binary path, shared for the whole run
+    _info = {}
+
+    def __init__(self, binary='nginx', cache='/root/.ngutil/nginx-V.json'):
+        super(_NGUtilNginx, self).__init__()
+
+        # NGINX binary / cached 'nginx -V' results
+        self.binary = binary
+        self.cache  = cache
+
+    def _which(self):
+        """
+        Locate the NGINX binary on the search path.
+        """
+        if '/' in self.binary:
+            return self.binary if access(self.binary, X_OK) else None
+        for dir in environ.get('PATH', '/usr/sbin:/usr/bin:/sbin:/bin').split(':') + ['/usr/sbin', '/sbin']:
+            candidate = path.join(dir, self.binary)
+            if path.isfile(candidate) and access(candidate, X_OK):
+                return candidate
+        return None
+
+    def _parse(self, output):
+        """
+        Parse 'nginx -V' output.
+        """
+        version = re.search(r'nginx/([0-9]+(?:\.[0-9]+)*)', output)
+        openssl = re.search(r'built with OpenSSL ([0-9]+(?:\.[0-9]+)*)', output)
+        return {
+            'version': [int(v) for v in version.group(1).split('.')] if version else [],
+            'openssl': [int(v) for v in openssl.group(1).split('.')] if openssl else [],
+            'modules': sorted(set(re.findall(r'--with-([A-Za-z0-9_]+_module)', output)))
+        }
+
+    def _load_cache(self):
+        """
+        Load cached results from previous runs.
+        """
+        if not path.isfile(self.cache):
+            return {}
+        fh = open(self.cache, 'r')
+        try:
+            return json.loads(fh.read())
+        except ValueError:
+            return {}
+        finally:
+            fh.close()
+
+    def info(self):
+        """
+        Return the NGINX version, OpenSSL version and compiled in modules, or
+        None if NGINX is not installed. Results are cached until the binary
+        changes.
+        """
+        binary = self._which()
+        if not binary:
+            return None
+        if binary in self._info:
+            return self._info[binary]
+
+        # Reuse results for the same binary
+        st  = stat(binary)
+        key = '{0}:{1}:{2}'.format(binary, int(st.st_mtime), st.st_size)
+        cached = self._load_cache()
+        if key in cached:
+            self._info[binary] = cached[key]
+            return cached[key]
+
+        # NGINX prints its build information on stderr
+        proc = Popen([binary, '-V'], stdout=PIPE, stderr=PIPE)
+        out, err = proc.communicate()
+        output = (out + err).decode('utf-8', 'replace') if isinstance(out, bytes) else out + err
+        if not proc.returncode == 0:
+            self.feedback.error('Failed to run \'{0} -V\': {1}'.format(binary, output.rstrip()))
+            return None
+        info = self._parse(output)
+        self.feedback.info('Detected NGINX {0} ({1} modules)'.format('.'.join([str(v) for v in info['version']]), len(info['modules'])))
+
+        # Remember the results, only for the current binary
+        self.write_file(self.cache, json.dumps({key: info}, indent=2, sort_keys=True), mode=0o600)
+        self._info[binary] = info
+        return info
+
+    def fingerprint(self):
+        """
+        Identify the installed NGINX binary and its build, changing whenever
+        NGINX is upgraded or rebuilt with other modules.
+        """
+        binary = self._which()
+        if not binary:
+            return 'none'
+        st = stat(binary)
+        return '{0}:{1}:{2}:{3}'.format(binary, st.st_mtime, st.st_size, json.dumps(self.info(), sort_keys=True))
+
+    def version(self):
+        """
+        Installed NGINX version as a list of integers.
+        """
+        return (self.info() or {}).get('version', [])
+
+    def has_module(self, name):
+        """
+        Check if a module was compiled into NGINX.
+        """
+        return name in (self.info() or {}).get('modules', [])
+
+    def http2(self):
+        """
+        How HTTP/2 is enabled: 'directive' ('http2 on;', 1.25.1+), 'listen'
+        ('listen ... http2', 1.9.5+), or None if unsupported.
+        """
+        if not self.has_module('http_v2_module'):
+            return None
+        if self.version() >= [1, 25, 1]:
+            return 'directive'
+        if self.version() >= [1, 9, 5]:
+            return 'listen'
+        return None
+
+    def tls13(self):
+        """
+        Check if TLSv1.3 is available, NGINX 1.13.0+ built with OpenSSL 1.1.1+.
+        """
+        info = self.info() or {}
+        return info.get('version', []) >= [1, 13, 0] and info.get('openssl', []) >= [1, 1, 1]
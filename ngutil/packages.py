@@ -0,0 +1,181 @@
+import re
+import threading
+from subprocess import Popen, PIPE
+
+# RPM module, falls back to querying the 'rpm' command
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
+# NGUtil Libraries
+from .common import _NGUtilCommon
+
+class _NGUtilPackages(_NGUtilCommon):
+    """
+    Class object for planning package installs against the RPM database.
+    """
+
+    # Package specification, i.e. 'nginx' or 'nginx >= 1.8'
+    SPEC = re.compile(r'^([^<>=!\s]+)\s*(?:(>=|<=|==|=|!=|>|<)\s*(\S+))?$')
+
+    # Version operators yum can install
+    YUM = ['=', '==', '>=', '>']
+
+    # Installed package versions by name, shared for the whole run
+    _cache = {}
+    _lock  = threading.Lock()
+
+    def parse(self, spec):
+        """
+        Split a package specification into (name, operator, version).
+        """
+        match = self.SPEC.match(spec.strip())
+        if not match:
+            self.die('Invalid package specification \'{0}\''.format(spec))
+        return match.group(1), match.group(2), match.group(3)
+
+    def _split_evr(self, evr):
+        """
+        Split an '[epoch:]version[-release]' string into a tuple.
+        """
+        epoch, _, rest = evr.rpartition(':')
+        version, _, release = rest.partition('-')
+        return (epoch or '0', version, release or None)
+
+    def _vercmp(self, a, b):
+        """
+        Compare two version strings using the RPM segment rules.
+        """
+        if a == b:
+            return 0
+        segs_a = re.findall(r'[0-9]+|[A-Za-z]+', a)
+        segs_b = re.findall(r'[0-9]+|[A-Za-z]+', b)
+        for seg_a, seg_b in zip(segs_a, segs_b):
+
+            # Numeric segments are newer than alphabetic segments
+            if seg_a.isdigit() != seg_b.isdigit():
+                return 1 if seg_a.isdigit() else -1
+            if seg_a.isdigit():
+                seg_a, seg_b = int(seg_a), int(seg_b)
+            if seg_a != seg_b:
+                return 1 if seg_a > seg_b else -1
+        return (len(segs_a) > len(segs_b)) - (len(segs_a) < len(segs_b))
+
+    def compare(self, a, b):
+        """
+        Compare two (epoch, version, release) tuples. A release of None
+        matches any release.
+        """
+        if a[2] is None or b[2] is None:
+            a, b = (a[0], a[1], None), (b[0], b[1], None)
+        if rpm:
+            return rpm.labelCompare(a, b)
+        for x, y in zip(a, b):
+            if x is None or y is None:
+                continue
+            result = self._vercmp(x, y)
+            if result:
+                return result
+        return 0
+
+    def _str(self, value):
+        """
+        Decode header / command output values.
+        """
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def _query(self, names):
+        """
+        Load installed versions of packages not yet cached, with indexed RPM
+        database lookups or a single batched 'rpm -q' call.
+        """
+        with self._lock:
+            missing = []
+            for name in names:
+                if not name in self._cache and not name in missing:
+                    missing.append(name)
+            if not missing:
+                return
+
+            # Look up each package by name in the RPM database index
+            if rpm:
+                ts = rpm.TransactionSet()
+                for name in missing:
+                    for hdr in ts.dbMatch('name', name):
+                        version, release = [self._str(hdr[k]) for k in ['version', 'release']]
+                        self._cache.setdefault(name, []).append((str(hdr['epochnum'] or 0), version, release))
+
+            # Query all missing packages in one call, which exits non-zero for
+            # packages that are not installed
+            else:
+                try:
+                    proc = Popen(['rpm', '-q', '--qf', '%{NAME} %{EPOCHNUM} %{VERSION} %{RELEASE}\\n'] + missing, stdout=PIPE, stderr=PIPE)
+                    out, err = proc.communicate()
+                except OSError as e:
+                    self.die('Failed to query the RPM database: {0}'.format(str(e)))
+                for line in self._str(out).splitlines():
+                    fields = line.split()
+                    if len(fields) == 4 and fields[0] in missing:
+                        self._cache.setdefault(fields[0], []).append(tuple(fields[1:]))
+            for name in missing:
+                self._cache.setdefault(name, [])
+
+    def installed(self, name):
+        """
+        Return the installed (epoch, version, release) tuples for a package.
+        """
+        self._query([name])
+        return list(self._cache.get(name, []))
+
+    def satisfied(self, spec):
+        """
+        Check if an installed package satisfies a specification.
+        """
+        name, op, version = self.parse(spec)
+        if not op:
+            return bool(self.installed(name))
+        wanted = self._split_evr(version)
+        for evr in self.installed(name):
+            result = self.compare(evr, wanted)
+            if {'>=': result >= 0, '<=': result <= 0, '>': result > 0, '<': result < 0, '!=': result != 0}.get(op, result == 0):
+                return True
+        return False
+
+    def plan(self, specs):
+        """
+        Work out which packages need to be installed, updated or downgraded.
+        Returns a dictionary of 'install', 'update' and 'downgrade' lists of
+        yum package arguments, 'name-version' for exact versions.
+        """
+        self._query([self.parse(spec)[0] for spec in specs])
+        plan = {'install': [], 'update': [], 'downgrade': []}
+        for spec in specs:
+            name, op, version = self.parse(spec)
+            if self.satisfied(spec):
+                self.feedback.info('Package \'{0}\' already installed, skipping...'.format(spec))
+                continue
+
+            # Yum installs exact versions or the newest available one
+            if op and not op in self.YUM:
+                self.die('Cannot install \'{0}\', yum only supports exact (=, ==) or minimum (>=, >) versions'.format(spec))
+            target = '{0}-{1}'.format(name, version) if op in ['=', '=='] else name
+            if not self.installed(name):
+                plan['install'].append(target)
+                self.feedback.info('Marking package \'{0}\' for installation...'.format(spec))
+            elif op in ['=', '=='] and [evr for evr in self.installed(name) if self.compare(evr, self._split_evr(version)) > 0]:
+                plan['downgrade'].append(target)
+                self.feedback.info('Marking package \'{0}\' for downgrade...'.format(spec))
+            else:
+                plan['update'].append(target)
+                self.feedback.info('Marking package \'{0}\' for update...'.format(spec))
+        return plan
+
+    def invalidate(self, names=None):
+        """
+        Drop cached package state after the RPM database changes, so those
+        packages are looked up again.
+        """
+        with self._lock:
+            for name in (names or list(self._cache.keys())):
+                self._cache.pop(name, None)
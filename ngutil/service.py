@@ -1,15 +1,136 @@
 from feedback import Feedback
 from subprocess import Popen, PIPE
 
+class _NGUtilServiceQueue(object):
+    """
+    Queue of requested service actions, collapsed and run once per command.
+    """
+    def __init__(self):
+        
+        # Queued services / requested actions
+        self._order   = []
+        self._queue   = {}
+        self._service = {}
+        
+        # Feedback handler
+        self.feedback = Feedback(use_timestamp=True)
+        
+    def _collapse(self, actions):
+        """
+        Collapse a list of requested actions into a single action.
+        """
+        
+        # Resulting action, keyed by (previous, requested)
+        transitions = {
+            (None,      'start'):   'start',
+            (None,      'stop'):    'stop',
+            (None,      'reload'):  'reload',
+            (None,      'restart'): 'reload',
+            ('start',   'start'):   'start',
+            ('start',   'stop'):    'stop',
+            ('start',   'reload'):  'reload',
+            ('start',   'restart'): 'reload',
+            ('stop',    'start'):   'restart',
+            ('stop',    'stop'):    'stop',
+            ('stop',    'reload'):  'restart',
+            ('stop',    'restart'): 'restart',
+            ('reload',  'start'):   'reload',
+            ('reload',  'stop'):    'stop',
+            ('reload',  'reload'):  'reload',
+            ('reload',  'restart'): 'reload',
+            ('restart', 'start'):   'restart',
+            ('restart', 'stop'):    'stop',
+            ('restart', 'reload'):  'restart',
+            ('restart', 'restart'): 'restart'
+        }
+        
+        # Fold the requested actions
+        action = None
+        for requested in actions:
+            action = transitions[(action, requested)]
+        return action
+        
+    def schedule(self, service, action):
+        """
+        Queue an action for a service.
+        """
+        if not action in ['start', 'stop', 'reload', 'restart']:
+            raise ValueError('Cannot queue unsupported service action: {0}'.format(action))
+        
+        # Track the service
+        if not service.name in self._queue:
+            self._order.append(service.name)
+            self._queue[service.name] = []
+        self._service[service.name] = service
+        
+        # Queue the action
+        self._queue[service.name].append(action)
+        
+    def pending(self, name=None):
+        """
+        Return the collapsed pending action for a service, or all services.
+        """
+        if name:
+            return self._collapse(self._queue.get(name, []))
+        return dict([(k, self._collapse(self._queue[k])) for k in self._order])
+        
+    def clear(self):
+        """
+        Discard all queued actions.
+        """
+        self._order = []
+        self._queue = {}
+        self._service = {}
+        
+    def flush(self):
+        """
+        Run the collapsed action for each queued service.
+        """
+        
+        # Swap out the queue so actions queued during the flush are kept
+        order, queue, services = self._order, self._queue, self._service
+        self.clear()
+        
+        # Run each service action
+        status = True
+        for name in order:
+            action  = self._collapse(queue[name])
+            service = services[name]
+            self.feedback.info('Running queued action for \'{0}\' service: {1} ({2} requested)'.format(name, action, len(queue[name])))
+            
+            # Refuse to (re)load a service with a broken configuration
+            if action in ['start', 'reload', 'restart'] and not service.check():
+                self.feedback.error('Skipping {0} for \'{1}\' service, configuration check failed'.format(action, name))
+                status = False
+                continue
+            
+            # Reload a stopped service by starting it
+            if action == 'reload' and not service.is_running():
+                action = 'start'
+                
+            # Nothing to do for a running service
+            elif action == 'start' and service.is_running():
+                continue
+            
+            if not service._do_service(action):
+                status = False
+        return status
+
+# Service actions queued for the current command
+service_queue = _NGUtilServiceQueue()
+
 class _NGUtilService(object):
     """
     Simple class wrapper for handling Linux services.
     """
-    def __init__(self, name):
+    def __init__(self, name, check=None):
         
         # Service name
         self.name = name
         
+        # Optional configuration check command
+        self._check = check
+        
         # Feedback handler
         self.feedback = Feedback(use_timestamp=True)
         
@@ -23,6 +144,27 @@ class _NGUtilService(object):
         # Return the status
         return True if ('running' in out.rstrip()) else False
         
+    def check(self):
+        """
+        Run the configuration check command for the service, if any.
+        """
+        if not self._check:
+            return True
+        proc = Popen(self._check, stdout=PIPE, stderr=PIPE)
+        out, err = proc.communicate()
+        
+        # Configuration check failed
+        if not proc.returncode == 0:
+            self.feedback.error('Configuration check for service \'{0}\' failed: {1}'.format(self.name, err.rstrip()))
+            return False
+        return True
+        
+    def schedule(self, state):
+        """
+        Queue a service action to run when the service queue is flushed.
+        """
+        service_queue.schedule(self, state)
+        
     def _do_service(self, state):
         """
         Wrapper for handling the service command argument.
@@ -89,13 +231,13 @@ class _NGUtilService(object):
         """
         Reload the service.
         """
-        self._do_service('reload')
+        return self._do_service('reload')
         
     def stop(self):
         """
         Stop the service.
         """
-        self._do_service('stop')
+        return self._do_service('stop')
         
     def start(self):
         """
@@ -1,12 +1,15 @@
 from __future__ import print_function
+import os
+import re
+import sys
 import json
 import shutil
-from os import symlink, path, unlink, listdir
+from copy import deepcopy
+from os import path
 
-# ngutil
-from .service import _NGUtilService
-from .template import _NGUtilTemplates
-from .common import _NGUtilCommon, _NGUtilSELinux
+# ngutil, other libraries are imported when first used
+from .service import _NGUtilService, service_queue
+from .common import _NGUtilCommon, _NGUtilSELinux, _NGUtilLazy
 
 class _NGUtilSite(_NGUtilCommon):
     """
@@ -15,38 +18,141 @@ class _NGUtilSite(_NGUtilCommon):
     def __init__(self):
         super(_NGUtilSite, self).__init__()
 
-        # Template manager
-        self.template = _NGUtilTemplates()
+        # SELinux manager
+        self.selinux  = None
 
-        # SSL attributes
-        self.ssl  = {
-            'enable': False,
-            'cert': None,
-            'key': None
-        }
+        # Per-site attributes
+        self._reset()
+
+        # Static asset profiles
+        self.static_profiles = ['default', 'performance']
 
-        # Site properties
-        self.properties = {}
+        # Upstream server parameters
+        self.server_params = re.compile(r'^((weight|max_fails|max_conns)=[0-9]+|fail_timeout=[0-9]+[smh]?|backup|down)$')
 
         # Required / optional params
         self.params = {
             'required': ['fqdn'],
-            'optional': ['default_doc', 'activate', 'ssl', 'ssl_cert', 'ssl_key']
+            'optional': ['default_doc', 'activate', 'ssl', 'ssl_cert', 'ssl_key', 'ssl_chain', 'source', 'fpm_pool', 'fpm_profile', 'backend', 'keepalive', 'static_profile', 'open_file_cache', 'microcache']
         }
         
         # Service handlers
         self.service = {
-            'nginx':   _NGUtilService('nginx')
+            'nginx':   _NGUtilService('nginx'),
+            'php-fpm': _NGUtilService('php-fpm', check=['php-fpm', '-t'])
+        }
+
+    @_NGUtilLazy
+    def template(self):
+        """
+        Site configuration template manager.
+        """
+        from .template import _NGUtilTemplates
+        return _NGUtilTemplates()
+
+    @_NGUtilLazy
+    def fpm_pools(self):
+        """
+        PHP-FPM pool manager, sizing every pool together.
+        """
+        from .fpm import _NGUtilFPM
+        return _NGUtilFPM(self.metadata, self.tuning)
+
+    @_NGUtilLazy
+    def metadata(self):
+        """
+        Site metadata store.
+        """
+        from .metadata import _NGUtilMetadata
+        return _NGUtilMetadata()
+
+    @_NGUtilLazy
+    def stage(self):
+        """
+        NGINX configuration stage.
+        """
+        from .stage import _NGUtilStage
+        return _NGUtilStage()
+
+    @_NGUtilLazy
+    def cache(self):
+        """
+        Download cache.
+        """
+        from .cache import _NGUtilCache
+        return _NGUtilCache()
+
+    @_NGUtilLazy
+    def source(self):
+        """
+        Site source deployment.
+        """
+        from .source import _NGUtilSource
+        return _NGUtilSource(cache=self.cache)
+
+    @_NGUtilLazy
+    def tuning(self):
+        """
+        Hardware / cgroup aware sizing.
+        """
+        from .tuning import _NGUtilTuning
+        return _NGUtilTuning()
+
+    @_NGUtilLazy
+    def nginx(self):
+        """
+        Installed NGINX version / modules.
+        """
+        from .nginx import _NGUtilNginx
+        return _NGUtilNginx()
+
+    def _reset(self):
+        """
+        Reset per-site attributes before defining a new site.
+        """
+
+        # SSL attributes
+        self.ssl  = {
+            'enable': False,
+            'cert': None,
+            'key': None,
+            'chain': None
+        }
+
+        # Dedicated PHP-FPM pool
+        self.fpm = {
+            'pool': None,
+            'socket': None
+        }
+
+        # FastCGI upstream
+        self.upstream = {
+            'name': None,
+            'servers': [],
+            'keepalive': 0
         }
 
+        # Static asset handling
+        self.static = {
+            'profile': 'default',
+            'open_file_cache': None
+        }
+
+        # FastCGI microcache
+        self.microcache = None
+
+        # Site properties / configuration
+        self.properties  = {}
+        self.site_config = {}
+
     def _setup_ssl_certs(self):
         """
         Setup SSL certificates if enabled.
         """
         if self.ssl['enable']:
             _sitename = self.properties['fqdn']
-            _cert_dst = '/srv/www/{0}/ssl/{1}.crt'.format(_sitename)
-            _key_dst  = '/srv/www/{0}/ssl/{1}.key'.format(_sitename)
+            _cert_dst = '/srv/www/{0}/ssl/{0}.crt'.format(_sitename)
+            _key_dst  = '/srv/www/{0}/ssl/{0}.key'.format(_sitename)
 
             # Deploy the SSL certificate
             shutil.copy(self.properties['ssl_cert'], _cert_dst)
@@ -56,14 +162,18 @@ class _NGUtilSite(_NGUtilCommon):
             shutil.copy(self.properties['ssl_key'], _key_dst)
             self.feedback.success('Deployed SSL key -> {0}'.format(_key_dst))
 
+            # Deploy the CA chain used to verify OCSP responses
+            if self.ssl.get('chain'):
+                _chain_dst = '/srv/www/{0}/ssl/{0}.chain.crt'.format(_sitename)
+                shutil.copy(self.ssl['chain'], _chain_dst)
+                self.feedback.success('Deployed SSL chain -> {0}'.format(_chain_dst))
+
     def _get_source(self):
         """
         Retrieve source code to put in the document root.
         """
         if self.properties['source']:
-
-            # Remote protocols
-            remote_proto = ['http', 'https', 'ftp']
+            self.source.deploy(self.properties['source'], '/srv/www/{0}/public'.format(self.properties['fqdn']))
 
     def _create_dirs(self):
         """
@@ -84,67 +194,139 @@ class _NGUtilSite(_NGUtilCommon):
         if self.ssl['enable']:
             self.mkdir('{0}/ssl'.format(site_base))
 
-        # Setup directory permissions
-        self.run_command('chown -R root:nginx {0}'.format(site_base))
-        self.run_command('chmod -R 750 {0}'.format(site_base))
+        # Setup permissions and SELinux types on the (still empty) site directories
+        self.set_permissions(site_base, owner='root', group='nginx', mode=0o750, context='httpd_sys_content_t', selinux=self.selinux)
 
-        # Set SELinux context
-        self.selinux.chcon(site_base, 'unconfined_u:object_r:httpd_sys_content_t:s0', recursive=True)
+        # PHP-FPM writes logs and sessions, file context rules keep the types on relabel
+        self.selinux.add_fcontext(site_base, 'httpd_sys_content_t')
+        for dir in ['logs', 'session']:
+            self.set_permissions('{0}/{1}'.format(site_base, dir), context='httpd_sys_rw_content_t', selinux=self.selinux)
+            self.selinux.add_fcontext('{0}/{1}'.format(site_base, dir), 'httpd_sys_rw_content_t')
+
+        # NGINX workers write the microcache
+        if self.properties.get('microcache'):
+            self.mkdir('{0}/cache'.format(site_base))
+            self.set_permissions('{0}/cache'.format(site_base), owner='nginx', group='nginx', mode=0o700, context='httpd_cache_t', selinux=self.selinux)
+            self.selinux.add_fcontext('{0}/cache'.format(site_base), 'httpd_cache_t')
+
+        # Deploy the site source code last, the extractor applies ownership and
+        # mode itself and new files inherit the document root's SELinux type
+        self._get_source()
     
     def _activate_site(self):
         """
         Optionally activate the site.
         """
-        if self.properties['activate']:
-            if not path.isfile(self.site_config['enabled']):
-                symlink(self.site_config['available'], self.site_config['enabled'])
+        if self.properties.get('activate'):
+            if self.stage.symlink(self.site_config['available'], self.site_config['enabled']):
                 self.feedback.success('Activated site -> {0}'.format(self.site_config['enabled']))
             else:
                 self.feedback.info('Site already activated -> {0}'.format(self.site_config['enabled']))
                 
-            # Restart services
-            self.service['nginx'].restart()
+    def _commit_config(self):
+        """
+        Validate and apply staged configuration, reloading NGINX if required.
+        """
+        if self.stage.commit():
+            self.service['nginx'].schedule('reload')
              
-    def list_all(self):
+    def _parse_filter(self, filters):
         """
-        List all managed sites with metdata.
+        Convert a comma separated list of filters to metadata query arguments.
         """
+        query = {}
+        for term in (filters or '').split(','):
+            term = term.strip()
+            if not term:
+                continue
+            if term in ['enabled', 'disabled']:
+                query['enabled'] = (term == 'enabled')
+            elif term in ['ssl', 'nossl']:
+                query['ssl'] = (term == 'ssl')
+            
+            # Anything else is a shell style pattern on the FQDN
+            else:
+                query['fqdn'] = term
+        return query
         
-        # Metadata directory
-        metadata_dir = '/root/.ngutil/metadata'
+    def _format_site(self, metadata, format):
+        """
+        Format the metadata for a single site.
+        """
+        
+        # JSON, one object per line
+        if format == 'json':
+            return '{0}\n'.format(json.dumps(metadata, sort_keys=True))
+        
+        # Tab separated values
+        if format == 'tsv':
+            return '{0}\n'.format('\t'.join([
+                metadata['fqdn'],
+                'yes' if metadata['enabled'] else 'no',
+                'yes' if metadata['ssl']['enable'] else 'no',
+                metadata['config']['available'],
+                metadata['ssl']['cert'] or '',
+                metadata['ssl']['key'] or ''
+            ]))
+            
+        # Site status
+        if metadata['enabled']:
+            site_status = 'Yes -> {0}'.format(metadata['config']['enabled'])
+        else:
+            site_status = 'No'
         
+        # Human readable text
+        lines = [
+            '',
+            'SITE: {0}'.format(metadata['fqdn']),
+            '> DocRoot: /srv/www/{0}'.format(metadata['fqdn']),
+            '> Config: {0}'.format(metadata['config']['available']),
+            '> Enabled: {0}'.format(site_status),
+            '> SSL Enabled: {0}'.format('Yes' if metadata['ssl']['enable'] else 'No')
+        ]
+        
+        # SSL information
+        if metadata['ssl']['enable']:
+            lines.append('> SSL Certificate: {0}'.format(metadata['ssl']['cert']))
+            lines.append('> SSL Key: {0}'.format(metadata['ssl']['key']))
+        return '{0}\n\n'.format('\n'.join(lines))
+        
+    def iter_sites(self, params=None):
+        """
+        Generator yielding formatted site listings.
+        """
+        params = params or {}
+        format = params.get('format') or 'text'
+        if not format in ['text', 'json', 'tsv']:
+            self.die('Invalid list format \'{0}\', must be one of: text, json, tsv'.format(format))
+        
+        # Query the metadata store
+        query = self._parse_filter(params.get('filter'))
+        for metadata in self.metadata.query(limit=params.get('limit'), offset=params.get('offset'), **query):
+            yield self._format_site(metadata, format)
+        
+    def list_all(self, params=None):
+        """
+        List all managed sites with metdata.
+        """
+        params = params or {}
+        sites  = 0
+        text   = (params.get('format') or 'text') == 'text'
+        
+        # Only records go to stdout for json / tsv listings
+        if not text:
+            self.metadata.stream = sys.stderr
+        for site in self.iter_sites(params):
+            sys.stdout.write(site)
+            sites += 1
+        sys.stdout.flush()
+            
         # If no metadata exists
-        if not path.isdir(metadata_dir) or listdir(metadata_dir) == []:
-            self.feedback.info('No site metadata defined...')
+        if not sites:
+            if text:
+                self.feedback.info('No site metadata defined...')
             return False
-        
-        # Process each metadata file
-        for file in listdir(metadata_dir):
-            print('')
-            if file.endswith('.json'):
-                fh = open('{0}/{1}'.format(metadata_dir, file), 'r')
-                metadata = json.loads(fh.read())
-                fh.close()
-                
-                # Site status
-                if path.isfile(metadata['config']['enabled']):
-                    site_status = 'Yes -> {0}'.format(metadata['config']['enabled'])
-                else:
-                    site_status = 'No'
-                
-                # Display the metadata
-                print('SITE: {0}'.format(metadata['fqdn']))
-                print('> DocRoot: /srv/www/{0}'.format(metadata['fqdn']))
-                print('> Config: {0}'.format(metadata['config']['available']))
-                print('> Enabled: {0}'.format(site_status))
-                print('> SSL Enabled: {0}'.format('Yes' if metadata['ssl']['enable'] else 'No'))
-                
-                # SSL information
-                if metadata['ssl']['enable']:
-                    print('> SSL Certificate: {0}'.format(metadata['ssl']['cert']))
-                    print('> SSL Key: {0}'.format(metadata['ssl']['key']))
-                    
-                print('')
+        return True
               
     def disable(self, params):
         """
@@ -171,11 +353,10 @@ class _NGUtilSite(_NGUtilCommon):
     
         # Disable the site
         else:
-            unlink(site_config['enabled'])
+            self.stage.unlink(site_config['enabled'])
+            self._commit_config()
+            self.metadata.set_enabled(target_site, False)
             self.feedback.success('Disabled site \'{0}\''.format(params['fqdn']))
-    
-            # Restart services
-            self.service['nginx'].restart()
                 
     def enable(self, params):
         """
@@ -205,55 +386,447 @@ class _NGUtilSite(_NGUtilCommon):
             return True
             
         # Activate the site
-        symlink(site_config['available'], site_config['enabled'])
+        self.stage.symlink(site_config['available'], site_config['enabled'])
+        self._commit_config()
+        self.metadata.set_enabled(target_site, True)
         self.feedback.success('Enabled site -> {0}'.format(site_config['enabled']))
     
-        # Restart services
-        self.service['nginx'].restart()
+    def sync(self, params):
+        """
+        Sync updated source code into a new release of an existing site.
+        """
+        
+        # Target site
+        target_site = params.get('fqdn', None)
+        
+        # If no site selected
+        if not target_site:
+            self.die('Cannot sync a site without specifying the --fqdn parameter...')
+            
+        # Make sure the site is managed
+        metadata = self.metadata.get(target_site)
+        if not metadata:
+            self.die('Site \'{0}\' not found, please use \'create_site\' first...'.format(target_site))
+            
+        # Source defaults to the one the site was created with
+        source = params.get('source') or metadata.get('source')
+        if not source:
+            self.die('No source defined for site \'{0}\', please specify the --source parameter...'.format(target_site))
+        self.cache.offline = bool(params.get('offline'))
+            
+        # Sites serving precompressed assets get siblings for new or changed
+        # files, unchanged files keep theirs from the previous release
+        prepare = None
+        if (metadata.get('static') or {}).get('gzip_static'):
+            from .compress import _NGUtilCompress
+            prepare = _NGUtilCompress(processes=self.tuning.cpus()).run
+            
+        # Build and activate the new release
+        keep    = params.get('keep')
+        release = self.source.sync(source, '/srv/www/{0}'.format(target_site),
+            checksum=bool(params.get('checksum')),
+            keep=3 if keep is None else keep,
+            prepare=prepare
+        )
+        
+        # PHP caches resolved paths, pick up the new release
+        self.service['php-fpm'].schedule('reload')
+        
+        # Drop file descriptors NGINX cached for the previous release
+        if (metadata.get('static') or {}).get('open_file_cache'):
+            self.service['nginx'].schedule('reload')
+        
+        # Remember the source for future syncs
+        if source != metadata.get('source'):
+            metadata['source'] = source
+            self.metadata.set(metadata, enabled=metadata['enabled'])
+        self.feedback.success('Synced site \'{0}\' -> {1}'.format(target_site, release))
     
-    def _generate_nginx_config(self):
+    def _generate_fpm_config(self, pools=None):
         """
-        Generate NGINX config files for the new site.
+        Queue a dedicated PHP-FPM pool for the site, listening on a unix
+        socket. Existing pools are resized to share memory with it unless the
+        total number of pools is given.
+        """
+        if not self.properties.get('fpm_pool'):
+            return
+        _sitename = self.properties['fqdn']
+        self.fpm  = {
+            'pool': '/etc/php-fpm.d/{0}.conf'.format(_sitename),
+            'socket': '/var/run/php-fpm/{0}.sock'.format(_sitename),
+            'profile': self.properties.get('fpm_profile') or 'density'
+        }
+        self.mkdir(path.dirname(self.fpm['socket']))
+
+        # Memory is shared between the default pool and every site pool
+        resize = pools is None
+        if resize:
+            pools = self.fpm_pools.count(exclude=[_sitename], extra=1)
+
+        # Queue the pool
+        template, self.fpm['max_children'] = self.fpm_pools.site(_sitename, self.fpm['socket'], pools, self.fpm['profile'])
+        self.fpm_pools.queue(template)
+
+        # Shrink the existing pools to make room
+        if resize:
+            self.fpm_pools.resize(pools, exclude=[_sitename])
+
+    def _apply_fpm_config(self):
         """
+        Write queued PHP-FPM pools once the NGINX configuration is accepted,
+        reloading PHP-FPM once its configuration checks out.
+        """
+        if self.fpm_pools.apply():
+            self.service['php-fpm'].schedule('reload')
+
+    def _load(self, metadata):
+        """
+        Load the attributes of an existing site from its metadata.
+        """
+        self._reset()
+        self.properties = dict([(k, None) for k in self.params['optional']])
+        self.properties.update({
+            'fqdn': metadata['fqdn'],
+            'default_doc': metadata.get('default_doc'),
+            'source': metadata.get('source')
+        })
+        self.ssl         = metadata['ssl']
+        self.site_config = metadata['config']
+        self.fpm         = metadata.get('fpm') or self.fpm
+        self.static      = metadata.get('static') or self.static
+        self.microcache  = metadata.get('microcache')
+
+        # Sites created before upstreams were stored get the default upstream
+        if metadata.get('upstream'):
+            self.upstream = metadata['upstream']
+        else:
+            self._define_upstream()
+
+    def compress(self, params):
+        """
+        Precompress static assets in a site's document root and serve them
+        with 'gzip_static'.
+        """
+        
+        # Target site
+        target_site = params.get('fqdn', None)
         
+        # If no site selected
+        if not target_site:
+            self.die('Cannot compress a site without specifying the --fqdn parameter...')
+            
+        # Make sure the site is managed
+        metadata = self.metadata.get(target_site)
+        if not metadata:
+            self.die('Site \'{0}\' not found, please use \'create_site\' first...'.format(target_site))
+        self._load(metadata)
+        
+        # Write compressed siblings, one process per CPU
+        from .compress import _NGUtilCompress
+        _NGUtilCompress(processes=self.tuning.cpus()).run('/srv/www/{0}/public'.format(target_site))
+        
+        # Serve the compressed siblings
+        if self.static.get('gzip_static'):
+            self.feedback.info('gzip_static already enabled for site \'{0}\''.format(target_site))
+            return True
+        self.static['gzip_static'] = True
+        self._generate_nginx_config(define=False)
+        self._commit_config()
+        
+        # Remember the setting for regenerated configurations
+        metadata['static'] = self.static
+        metadata['upstream'] = self.upstream
+        self.metadata.set(metadata, enabled=metadata['enabled'])
+        self.feedback.success('Enabled gzip_static for site \'{0}\''.format(target_site))
+        
+    def _define_upstream(self):
+        """
+        Define the FastCGI upstream for the site: the site's own pool, any
+        additional backends, or the shared pool.
+        """
+        backends = self.properties.get('backend') or []
+        if not isinstance(backends, list):
+            backends = [backends]
+        servers = ['unix:{0}'.format(self.fpm['socket'])] if self.fpm['socket'] else []
+
+        # Backends as 'address [parameter ...]', default to the PHP-FPM port
+        for backend in backends:
+            fields  = str(backend).split()
+            if not fields:
+                continue
+            address = fields[0] if fields[0].startswith('unix:') or ':' in fields[0] else '{0}:9000'.format(fields[0])
+            invalid = [f for f in fields[1:] if not self.server_params.match(f)]
+            if invalid:
+                self.die('Invalid parameter(s) for backend \'{0}\': {1}'.format(backend, ' '.join(invalid)))
+            servers.append(' '.join([address] + fields[1:]))
+
+        # Kept connections pin PHP-FPM workers, leave at least half the pool
+        # free for new connections
+        keepalive = self.properties.get('keepalive')
+        if keepalive is None:
+            keepalive = 8
+            if self.fpm.get('max_children'):
+                keepalive = max(1, min(keepalive, self.fpm['max_children'] // (2 * self.tuning.cpus())))
+        self.upstream = {
+            'name': 'php_{0}'.format(re.sub(r'[^A-Za-z0-9]', '_', self.properties['fqdn'])),
+            'servers': servers or ['127.0.0.1:9000'],
+            'keepalive': int(keepalive)
+        }
+
+    def _render_upstream(self):
+        """
+        Render the upstream block for the site.
+        """
+        lines = ['upstream {0} {{'.format(self.upstream['name'])]
+        lines.extend(['    server {0};'.format(server) for server in self.upstream['servers']])
+        if self.upstream['keepalive']:
+            lines.append('    keepalive {0};'.format(self.upstream['keepalive']))
+        return '\n'.join(lines + ['}'])
+
+    def _define_static(self):
+        """
+        Define static asset handling, sizing the open file cache from the
+        number of files in the document root.
+        """
+        profile = self.properties.get('static_profile') or 'default'
+        if not profile in self.static_profiles:
+            self.die('Invalid static profile \'{0}\', must be one of: {1}'.format(profile, ', '.join(self.static_profiles)))
+        self.static = {
+            'profile': profile,
+            'open_file_cache': None,
+            'gzip_static': profile == 'performance'
+        }
+
+        # Room for every file in the document root, with headroom for growth
+        if profile == 'performance' and self.properties.get('open_file_cache'):
+            files = 0
+            for dirpath, dirnames, filenames in os.walk('/srv/www/{0}/public'.format(self.properties['fqdn'])):
+                files += len(filenames)
+            self.static['open_file_cache'] = max(1000, min(files * 2, 200000))
+            self.feedback.info('Sized open file cache for {0} file(s): max={1}'.format(files, self.static['open_file_cache']))
+
+    def _render_static(self):
+        """
+        Render the static asset directives for the site.
+        """
+        lines = []
+
+        # Serve precompressed siblings where present
+        if self.static.get('gzip_static'):
+            lines.extend([
+                '    gzip_static     on;',
+                ''
+            ])
+        if self.static['profile'] == 'default':
+            return '\n'.join(lines + [
+                r'    location ~* \.(jpg|jpeg|gif|png|js|ico|xml|css)$ {',
+                '        server_tokens   off;',
+                '        access_log      off;',
+                '        log_not_found   off;',
+                '        expires         360d;',
+                '    }'
+            ])
+
+        # Send files straight from the page cache, filling whole packets
+        lines.extend([
+            '    sendfile        on;',
+            '    tcp_nopush      on;',
+            ''
+        ])
+
+        # Cache file descriptors and metadata for the whole document root
+        if self.static['open_file_cache']:
+            lines.extend([
+                '    open_file_cache          max={0} inactive=60s;'.format(self.static['open_file_cache']),
+                '    open_file_cache_valid    120s;',
+                '    open_file_cache_min_uses 2;',
+                '    open_file_cache_errors   on;',
+                ''
+            ])
+
+        return '\n'.join(lines + [
+            r'    location ~* \.(jpg|jpeg|gif|png|webp|avif|svg|svgz|ico|js|css|xml|txt|woff|woff2|ttf|otf|eot)$ {',
+            '        server_tokens   off;',
+            '        access_log      off;',
+            '        log_not_found   off;',
+            '        expires         360d;',
+            '    }'
+        ])
+
+    def _define_microcache(self):
+        """
+        Define the FastCGI microcache zone, sized from the free disk space
+        under the site directory.
+        """
+        if not self.properties.get('microcache'):
+            self.microcache = None
+            return
+        cache_dir = '/srv/www/{0}/cache'.format(self.properties['fqdn'])
+        st        = os.statvfs(cache_dir)
+
+        # Up to 5% of free space between 64MB and 1GB, with a key per 16KB entry
+        max_size  = max(64, min((st.f_bavail * st.f_frsize) // 20 // 1048576, 1024))
+        self.microcache = {
+            'zone': 'fcgi_{0}'.format(re.sub(r'[^A-Za-z0-9]', '_', self.properties['fqdn'])),
+            'path': cache_dir,
+            'max_size': max_size,
+            'keys_zone': max(1, max_size * 64 // 8000)
+        }
+        self.feedback.info('Sized microcache for site \'{0}\': max_size={1}m, keys_zone={2}m'.format(
+            self.properties['fqdn'], max_size, self.microcache['keys_zone']
+        ))
+
+    def _render_cache_path(self):
+        """
+        Render the HTTP level cache zone for the site.
+        """
+        if not self.microcache:
+            return ''
+        return 'fastcgi_cache_path {0} levels=1:2 keys_zone={1}:{2}m max_size={3}m inactive=10m;'.format(
+            self.microcache['path'], self.microcache['zone'], self.microcache['keys_zone'], self.microcache['max_size']
+        )
+
+    def _render_microcache(self):
+        """
+        Render the microcache directives for the PHP location. Responses
+        setting cookies are never cached by NGINX.
+        """
+        if not self.microcache:
+            return ''
+        return '\n'.join([
+            '        set $skip_cache 0;',
+            '        if ($request_method !~ ^(GET|HEAD)$) {',
+            '            set $skip_cache 1;',
+            '        }',
+            '        if ($http_cookie ~* "SESS|session|logged_in|wordpress_|wp-postpass|comment_author") {',
+            '            set $skip_cache 1;',
+            '        }',
+            '        fastcgi_cache            {0};'.format(self.microcache['zone']),
+            '        fastcgi_cache_key        $scheme$request_method$host$request_uri;',
+            '        fastcgi_cache_valid      200 301 302 1s;',
+            '        fastcgi_cache_bypass     $skip_cache;',
+            '        fastcgi_no_cache         $skip_cache;',
+            '        fastcgi_cache_lock       on;',
+            '        fastcgi_cache_use_stale  updating error timeout invalid_header http_500 http_503;'
+        ])
+
+    def _resolvers(self):
+        """
+        Name servers from the resolver configuration, for OCSP stapling.
+        """
+        if not path.isfile('/etc/resolv.conf'):
+            return []
+        fh = open('/etc/resolv.conf', 'r')
+        servers = re.findall(r'^\s*nameserver\s+(\S+)', fh.read(), re.M)
+        fh.close()
+        return [('[{0}]'.format(s) if ':' in s else s) for s in servers]
+
+    def _render_listen(self):
+        """
+        Render the HTTPS listen parameters.
+        """
+        if self.nginx.http2() == 'listen':
+            return '443 ssl http2'
+        if self.nginx.has_module('http_spdy_module'):
+            return '443 ssl spdy'
+        return '443 ssl'
+
+    def _render_tls(self):
+        """
+        Render the TLS directives for the HTTPS server.
+        """
+        lines = []
+        if self.nginx.http2() == 'directive':
+            lines.append('    http2                      on;')
+        lines.extend([
+            '    ssl_protocols              {0};'.format('TLSv1.2 TLSv1.3' if self.nginx.tls13() else 'TLSv1.2'),
+            '    ssl_ciphers                \'{0}\';'.format(':'.join([
+                'ECDHE-ECDSA-AES128-GCM-SHA256', 'ECDHE-RSA-AES128-GCM-SHA256',
+                'ECDHE-ECDSA-AES256-GCM-SHA384', 'ECDHE-RSA-AES256-GCM-SHA384',
+                'ECDHE-ECDSA-CHACHA20-POLY1305', 'ECDHE-RSA-CHACHA20-POLY1305',
+                'DHE-RSA-AES128-GCM-SHA256', 'DHE-RSA-AES256-GCM-SHA384'
+            ])),
+            '    ssl_prefer_server_ciphers  on;'
+        ])
+
+        # Staple OCSP responses, which needs a resolver for the responder. The
+        # session cache is shared from nginx.conf
+        resolvers = self._resolvers()
+        if resolvers:
+            lines.extend([
+                '    ssl_stapling               on;',
+                '    resolver                   {0} valid=300s;'.format(' '.join(resolvers)),
+                '    resolver_timeout           5s;'
+            ])
+
+            # Responses can only be verified against the site's CA chain
+            if self.ssl.get('chain'):
+                lines.extend([
+                    '    ssl_stapling_verify        on;',
+                    '    ssl_trusted_certificate    /srv/www/{0}/ssl/{0}.chain.crt;'.format(self.properties['fqdn'])
+                ])
+        return '\n'.join(lines)
+
+    def _generate_nginx_config(self, define=True):
+        """
+        Generate NGINX config files for the new site. Returns True if changed.
+        """
+        
+        # Upstream / static settings, unless loaded from metadata
+        if define:
+            self._define_upstream()
+            self._define_static()
+            self._define_microcache()
+
         # Setup the template
         self.template.setup(('NG_HTTPS' if self.ssl['enable'] else 'NG_HTTP'), self.site_config['available'])
 
+        # HTTPS listen / TLS settings for the installed NGINX
+        if self.ssl['enable']:
+            self.template.setvars({
+                'LISTEN': self._render_listen(),
+                'TLS': self._render_tls()
+            })
+
         # Update placeholder variables
         self.template.setvars({
             'SITENAME': self.properties['fqdn'],
-            'DEFAULTDOC': 'index.php' if not self.properties['default_doc'] else self.properties['default_doc']
+            'DEFAULTDOC': 'index.php' if not self.properties.get('default_doc') else self.properties['default_doc'],
+            'UPSTREAM': self._render_upstream(),
+            'STATIC': self._render_static(),
+            'CACHEPATH': self._render_cache_path(),
+            'MICROCACHE': self._render_microcache(),
+            'FASTCGIPASS': self.upstream['name'],
+            'KEEPCONN': 'on' if self.upstream['keepalive'] else 'off'
         })
     
-        # Deploy the configuration
-        self.template.deploy(overwrite=True)
+        # Stage the configuration
+        return self.template.deploy(overwrite=True, stage=self.stage)
         
     def _set_metadata(self):
         """
         Create metadata entry for site.
         """
-                
-        # Site metadata location
-        metadata_dir  = '/root/.ngutil/metadata'
-        metadata_site = '{0}/{1}.json'.format(metadata_dir, self.properties['fqdn'])
-        
-        # Make sure the metadata directory exists
-        self.mkdir(metadata_dir)
         
         # Define the site metadata
-        metadata_json = {
+        metadata = {
             'fqdn': self.properties['fqdn'],
             'config': {
                 'available': '/etc/nginx/sites-available/{0}.conf'.format(self.properties['fqdn']),
                 'enabled': '/etc/nginx/sites-enabled/{0}.conf'.format(self.properties['fqdn'])           
             },
             'ssl': self.ssl,
+            'fpm': self.fpm,
+            'upstream': self.upstream,
+            'static': self.static,
+            'microcache': self.microcache,
+            'default_doc': self.properties.get('default_doc'),
             'source': self.properties.get('source', False)
         }
         
-        # Write the site metadata
-        self.mkfile(metadata_site, contents=json.dumps(metadata_json))
-        self.feedback.success('Created site metadata -> {0}'.format(metadata_site))
+        # Store the site metadata
+        self.metadata.set(metadata, enabled=bool(self.properties.get('activate')))
+        self.feedback.success('Created site metadata -> {0}'.format(self.properties['fqdn']))
         
     def _define(self, params):
         """
@@ -261,7 +834,14 @@ class _NGUtilSite(_NGUtilCommon):
         """
 
         # SELinux manager
-        self.selinux  = _NGUtilSELinux()
+        if not self.selinux:
+            self.selinux = _NGUtilSELinux()
+
+        # Clear attributes from any previously defined site
+        self._reset()
+
+        # Only use cached remote sources
+        self.cache.offline = bool(params.get('offline'))
 
         # Make sure all required arguments are set
         for k in self.params['required']:
@@ -279,13 +859,19 @@ class _NGUtilSite(_NGUtilCommon):
 
                 # Make sure the file exists
                 ssl_file = params.get(k)
-                if not os.path.isfile(ssl_file):
+                if not path.isfile(ssl_file):
                     self.die('Could not locate \'{0}\' file \'{1}\''.format(k, ssl_file))
 
             # Set the SSL key and certificate
             self.ssl['key'] = params.get('ssl_key')
-            self.ssl['cert'] = params.args.get('ssl_cert')
-            self.feedback.info('Using SSL for site \'{0}\': cert={1}, key={2}'.format(params['fqdn'], params['ssl_cert'], param['ssl_key']))
+            self.ssl['cert'] = params.get('ssl_cert')
+
+            # Optional CA chain for OCSP stapling
+            if params.get('ssl_chain'):
+                if not path.isfile(params['ssl_chain']):
+                    self.die('Could not locate \'ssl_chain\' file \'{0}\''.format(params['ssl_chain']))
+                self.ssl['chain'] = params['ssl_chain']
+            self.feedback.info('Using SSL for site \'{0}\': cert={1}, key={2}'.format(params['fqdn'], params['ssl_cert'], params['ssl_key']))
         else:
             self.feedback.info('Not using SSL for site \'{0}\''.format(params['fqdn']))
             
@@ -300,7 +886,8 @@ class _NGUtilSite(_NGUtilCommon):
             self.die('Site \'{0}\' already defined in \'{1}\''.format(params['fqdn'], self.site_config['available']))
 
         # Merge with site properties
-        self.properties = params
+        self.properties = dict([(k, None) for k in self.params['optional']])
+        self.properties.update(params)
 
     def create(self, args):
         """
@@ -311,9 +898,13 @@ class _NGUtilSite(_NGUtilCommon):
         # Run internal methods
         self._define(args)
         self._create_dirs()
+        self.selinux.commit()
         self._setup_ssl_certs()
+        self._generate_fpm_config()
         self._generate_nginx_config()
         self._activate_site()
+        self._commit_config()
+        self._apply_fpm_config()
         self._set_metadata()
         
         # Site created
@@ -322,6 +913,117 @@ class _NGUtilSite(_NGUtilCommon):
             '> Web Root:    /srv/www/{0}'.format(self.properties['fqdn']),
             '> Default Doc: /srv/www/{0}/{1}'.format(self.properties['fqdn'], 'index.php' if not self.properties['default_doc'] else self.properties['default_doc']),
             '> Logs:        /srv/www/{0}/logs'.format(self.properties['fqdn']),
+            '> PHP-FPM:     {0}'.format(', '.join(self.upstream['servers'])),
             '> Active:      {0}\n'.format('Yes -> {0}'.format('/etc/nginx/sites-enabled/{0}.conf'.format(self.properties['fqdn'])) if self.properties['activate'] else 'No'),
             'You can activate the site using: ngutil enable_site --fqdn "{0}"'.format(self.properties['fqdn'])
         ], 'COMPLETE')
+
+    def _load_manifest(self, manifest, options=None):
+        """
+        Load a list of site definitions from a JSON or YAML manifest. Command
+        line options are used as defaults for every site.
+        """
+        if not manifest:
+            self.die('Cannot create sites without specifying the --manifest parameter...')
+        if not path.isfile(manifest):
+            self.die('Could not locate manifest file \'{0}\''.format(manifest))
+
+        # Read the manifest
+        fh = open(manifest, 'r')
+        contents = fh.read()
+        fh.close()
+
+        # YAML manifest
+        if manifest.endswith(('.yml', '.yaml')):
+            try:
+                import yaml
+            except ImportError:
+                self.die('Cannot load YAML manifest \'{0}\', PyYAML is not available'.format(manifest))
+            try:
+                data = yaml.safe_load(contents)
+            except Exception as e:
+                self.die('Failed to parse YAML manifest \'{0}\': {1}'.format(manifest, str(e)))
+
+        # JSON manifest
+        else:
+            try:
+                data = json.loads(contents)
+            except Exception as e:
+                self.die('Failed to parse JSON manifest \'{0}\': {1}'.format(manifest, str(e)))
+
+        # Manifest may be a list of sites or a mapping with defaults
+        if isinstance(data, dict):
+            defaults = data.get('defaults') or {}
+            sites    = data.get('sites') or []
+        else:
+            defaults = {}
+            sites    = data or []
+        if not isinstance(sites, list):
+            self.die('Manifest \'{0}\' must define a list of sites'.format(manifest))
+
+        # Merge each site with the command line options and manifest defaults
+        _sites = []
+        _fqdns = []
+        for site in sites:
+            if not isinstance(site, dict) or not site.get('fqdn'):
+                self.die('Invalid site definition in manifest \'{0}\': {1}'.format(manifest, repr(site)))
+            if site['fqdn'] in _fqdns:
+                self.die('Site \'{0}\' defined more than once in manifest \'{1}\''.format(site['fqdn'], manifest))
+            if path.isfile('/etc/nginx/sites-available/{0}.conf'.format(site['fqdn'])):
+                self.die('Site \'{0}\' already defined in \'/etc/nginx/sites-available/{0}.conf\''.format(site['fqdn']))
+
+            _site = deepcopy(options or {})
+            _site.update(deepcopy(defaults))
+            _site.update(site)
+            _sites.append(_site)
+            _fqdns.append(site['fqdn'])
+        return _sites
+
+    def create_batch(self, args):
+        """
+        Create all site definitions in a manifest with a single NGINX reload.
+        """
+        # Site options given on the command line apply to every site
+        options = dict([(k, v) for k, v in args.items() if k in self.params['optional'] + ['offline'] and v is not None and v is not False and v != []])
+        sites   = self._load_manifest(args.get('manifest'), options)
+        if not sites:
+            self.feedback.info('No sites defined in manifest, nothing to do...')
+            return False
+        self.feedback.info('Preparing to setup {0} NGINX site(s)'.format(len(sites)))
+
+        # Size every PHP-FPM pool once for all the new site pools
+        fqdns = [site['fqdn'] for site in sites]
+        pools = self.fpm_pools.count(exclude=fqdns, extra=len([site for site in sites if site.get('fpm_pool')]))
+
+        # Create each site, staging all configuration changes
+        with self.metadata.transaction():
+            for site in sites:
+                self._define(site)
+                self._create_dirs()
+                self._setup_ssl_certs()
+                self._generate_fpm_config(pools)
+                self._generate_nginx_config()
+                self._activate_site()
+                self._set_metadata()
+                self.feedback.success('Created site -> {0}'.format(self.properties['fqdn']))
+                
+            # Shrink the existing pools to make room for the new ones
+            if [site for site in sites if site.get('fpm_pool')]:
+                self.fpm_pools.resize(pools, exclude=fqdns)
+
+            # Label all site directories at once
+            self.selinux.commit()
+                
+            # Validate the whole batch once, discarding it on failure, and only
+            # then write the PHP-FPM pools
+            self._commit_config()
+            self._apply_fpm_config()
+
+        # Reload once for the whole batch
+        service_queue.flush()
+
+        # Sites created
+        self.feedback.block([
+            'SITES CREATED: {0}'.format(len(sites)),
+            '> Activated:   {0}'.format(len([s for s in sites if s.get('activate')]))
+        ], 'COMPLETE')
@@ -0,0 +1,406 @@
+import time
+import fcntl
+import shutil
+import tarfile
+import zipfile
+from pwd import getpwnam
+from grp import getgrnam
+from os import path, makedirs, listdir, symlink, readlink, chown, chmod, lchown, fchown, fchmod, unlink, \
+    link, lstat, utime, walk, rename, getpid
+
+# Linux FICLONE ioctl, copy-on-write clone of a file
+FICLONE = 0x40049409
+
+# NGUtil Libraries
+from .common import _NGUtilCommon
+from .cache import _NGUtilCache
+
+class _NGUtilSource(_NGUtilCommon):
+    """
+    Class object for streaming site source code into a document root.
+    """
+
+    # Remote protocols
+    REMOTE = ['http', 'https', 'ftp']
+
+    # Archive extensions, zip archives need random access
+    TAR = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+    ZIP = ('.zip',)
+
+    # Precompressed siblings served with gzip_static
+    SIBLINGS = ('.gz',)
+
+    def __init__(self, cache=None, chunk_size=1048576):
+        super(_NGUtilSource, self).__init__()
+
+        # Download cache / copy buffer size
+        self.cache      = cache or _NGUtilCache()
+        self.chunk_size = chunk_size
+
+        # Ownership / mode applied while extracting / directories already set
+        self._uid  = -1
+        self._gid  = -1
+        self._mode = None
+        self._dirs = set()
+
+        # Resolved directory all writes must stay inside
+        self._root = None
+
+    def is_remote(self, source):
+        """
+        Check if a source is a remote URL.
+        """
+        return source.split('://', 1)[0] in self.REMOTE
+
+    def _name(self, source):
+        """
+        Lower case file name of a source, without any query string.
+        """
+        return source.split('?', 1)[0].rstrip('/').lower()
+
+    def _target(self, target, name):
+        """
+        Map an archive member to a path inside the target directory.
+        """
+        parts = name.replace('\\', '/').split('/')
+        if name.startswith('/') or '..' in parts:
+            self.die('Refusing to extract unsafe archive member \'{0}\''.format(name))
+        return path.join(target, *[p for p in parts if p and p != '.'])
+
+    def _check(self, _path):
+        """
+        Refuse to write through symbolic links that lead outside the root.
+        """
+        resolved = path.realpath(_path)
+        if self._root and not (resolved + '/').startswith(self._root.rstrip('/') + '/'):
+            self.die('Refusing to write outside of \'{0}\': {1} -> {2}'.format(self._root, _path, resolved))
+
+    def _mkdir(self, dir):
+        """
+        Make a directory with the deployment ownership / mode.
+        """
+        if dir in self._dirs:
+            return
+        self._check(dir)
+        self._dirs.add(dir)
+        if not path.isdir(dir):
+            makedirs(dir)
+        chown(dir, self._uid, self._gid)
+        if self._mode is not None:
+            chmod(dir, self._mode)
+
+    def _write(self, fileobj, dst, mtime=None):
+        """
+        Stream a file object to a destination in chunks, keeping the source
+        modification time so later syncs can detect unchanged files.
+        """
+        self._mkdir(path.dirname(dst))
+        self._check(path.dirname(dst))
+        if path.islink(dst):
+            unlink(dst)
+        fh = open(dst, 'wb')
+        try:
+            fchown(fh.fileno(), self._uid, self._gid)
+            if self._mode is not None:
+                fchmod(fh.fileno(), self._mode)
+            shutil.copyfileobj(fileobj, fh, self.chunk_size)
+        finally:
+            fh.close()
+        if mtime is not None:
+            utime(dst, (mtime, mtime))
+
+    def _symlink(self, target, link_target, dst):
+        """
+        Create a symbolic link if it resolves inside the target directory.
+        """
+        self._mkdir(path.dirname(dst))
+        self._check(path.dirname(dst))
+
+        # Resolve against the real parent, earlier links may point elsewhere
+        resolved = path.realpath(path.join(path.realpath(path.dirname(dst)), link_target))
+        if path.isabs(link_target) or not (resolved + '/').startswith(path.realpath(target) + '/'):
+            self.feedback.info('Skipping symbolic link outside of document root: {0} -> {1}'.format(dst, link_target))
+            return
+        if path.lexists(dst):
+            unlink(dst)
+        symlink(link_target, dst)
+        lchown(dst, self._uid, self._gid)
+
+    def _extract_tar(self, stream, target):
+        """
+        Extract a tar stream member by member, in a single pass.
+        """
+        archive = tarfile.open(fileobj=stream, mode='r|*')
+        count   = 0
+        try:
+            for member in archive:
+                dst = self._target(target, member.name)
+                if member.isdir():
+                    self._mkdir(dst)
+                elif member.isfile():
+                    self._write(archive.extractfile(member), dst, member.mtime)
+                elif member.issym():
+                    self._symlink(target, member.linkname, dst)
+                else:
+                    self.feedback.info('Skipping unsupported archive member: {0}'.format(member.name))
+                    continue
+                count += 1
+        finally:
+            archive.close()
+        return count
+
+    def _extract_zip(self, file, target):
+        """
+        Extract a zip archive member by member.
+        """
+        archive = zipfile.ZipFile(file)
+        count   = 0
+        try:
+            for info in archive.infolist():
+                dst = self._target(target, info.filename)
+                if info.filename.endswith('/'):
+                    self._mkdir(dst)
+                else:
+                    member = archive.open(info)
+                    try:
+                        self._write(member, dst, time.mktime(info.date_time + (0, 0, -1)))
+                    finally:
+                        member.close()
+                count += 1
+        finally:
+            archive.close()
+        return count
+
+    def _copy_tree(self, source, target):
+        """
+        Copy a local directory tree.
+        """
+        count = 0
+        self._mkdir(target)
+        for name in listdir(source):
+            src = path.join(source, name)
+            dst = path.join(target, name)
+            if path.islink(src):
+                self._symlink(target, readlink(src), dst)
+            elif path.isdir(src):
+                count += self._copy_tree(src, dst)
+            else:
+                fh = open(src, 'rb')
+                try:
+                    self._write(fh, dst, lstat(src).st_mtime)
+                finally:
+                    fh.close()
+            count += 1
+        return count
+
+    def _open(self, source):
+        """
+        Open a source as a readable stream, preferring the download cache.
+        """
+        if not self.is_remote(source):
+            return open(source, 'rb')
+
+        # Cached or offline sources are read from the cache
+        cached = self.cache.lookup(source)
+        if cached or self.cache.offline:
+            return open(cached or self.cache.fetch(source), 'rb')
+
+        # Otherwise stream directly from the remote server
+        try:
+            return self.cache.open(source)
+        except Exception as e:
+            self.die('Failed to fetch \'{0}\': {1}'.format(source, str(e)))
+
+    def deploy(self, source, target, owner='root', group='nginx', mode=0o750):
+        """
+        Deploy a directory, tar or zip archive (local or remote) into a target
+        directory, applying ownership and mode as each entry is written.
+        """
+        self._uid  = getpwnam(owner).pw_uid if owner else -1
+        self._gid  = getgrnam(group).gr_gid if group else -1
+        self._mode = mode
+        self._dirs = set()
+        self._root = path.realpath(target)
+        name       = self._name(source)
+
+        # Local directory
+        if not self.is_remote(source) and path.isdir(source):
+            count = self._copy_tree(source, target)
+
+        # Zip archives need random access, so remote archives go through the cache
+        elif name.endswith(self.ZIP) or (not self.is_remote(source) and zipfile.is_zipfile(source)):
+            count = self._extract_zip(self.cache.fetch(source) if self.is_remote(source) else source, target)
+
+        # Tar archives (optionally compressed) are streamed
+        elif name.endswith(self.TAR) or not self.is_remote(source):
+            if not self.is_remote(source) and not path.isfile(source):
+                self.die('Could not locate site source \'{0}\''.format(source))
+            stream = self._open(source)
+            try:
+                count = self._extract_tar(stream, target)
+            except tarfile.TarError as e:
+                self.die('Failed to extract site source \'{0}\': {1}'.format(source, str(e)))
+            finally:
+                stream.close()
+        else:
+            self.die('Unsupported site source \'{0}\', must be a directory, tar or zip archive'.format(source))
+
+        self.feedback.success('Deployed site source: {0} -> {1} ({2} entries)'.format(source, target, count))
+        return count
+
+    def _same(self, src, dst, checksum=False):
+        """
+        Check if a destination file matches a source file by size / mtime and
+        optionally by content hash.
+        """
+        try:
+            src_st = lstat(src)
+            dst_st = lstat(dst)
+        except OSError:
+            return False
+        if src_st.st_size != dst_st.st_size or int(src_st.st_mtime) != int(dst_st.st_mtime):
+            return False
+        return not checksum or self._hash_file(src) == self._hash_file(dst)
+
+    def _clone(self, src, dst):
+        """
+        Copy a file, using a copy-on-write reflink where the filesystem
+        supports it, preserving the modification time.
+        """
+        self._mkdir(path.dirname(dst))
+        src_fh = open(src, 'rb')
+        dst_fh = open(dst, 'wb')
+        try:
+            fchown(dst_fh.fileno(), self._uid, self._gid)
+            if self._mode is not None:
+                fchmod(dst_fh.fileno(), self._mode)
+            try:
+                fcntl.ioctl(dst_fh.fileno(), FICLONE, src_fh.fileno())
+            except (IOError, OSError):
+                shutil.copyfileobj(src_fh, dst_fh, self.chunk_size)
+        finally:
+            src_fh.close()
+            dst_fh.close()
+        st = lstat(src)
+        utime(dst, (st.st_atime, st.st_mtime))
+
+    def _sync_tree(self, source, current, release, checksum=False):
+        """
+        Build a release from a source directory, hard linking files unchanged
+        since the current release. Returns (linked, copied, deleted) counts.
+        """
+        linked = copied = 0
+        synced = set()
+        self._mkdir(release)
+        for dirpath, dirnames, filenames in walk(source):
+            rel_dir = path.relpath(dirpath, source)
+            for name in dirnames + filenames:
+                src = path.join(dirpath, name)
+                rel = path.normpath(path.join(rel_dir, name))
+                dst = path.join(release, rel)
+                synced.add(rel)
+
+                # Symbolic links / directories
+                if path.islink(src):
+                    self._symlink(release, readlink(src), dst)
+                elif path.isdir(src):
+                    self._mkdir(dst)
+
+                # Unchanged files are hard linked from the current release
+                elif current and self._same(src, path.join(current, rel), checksum):
+                    self._mkdir(path.dirname(dst))
+                    link(path.join(current, rel), dst)
+                    linked += 1
+                else:
+                    self._clone(src, dst)
+                    copied += 1
+
+        # Entries only in the current release are dropped, except compressed
+        # siblings of files that are unchanged (hard linked) in the new release
+        deleted = 0
+        if current:
+            for dirpath, dirnames, filenames in walk(current):
+                rel_dir = path.relpath(dirpath, current)
+                for name in filenames:
+                    rel = path.normpath(path.join(rel_dir, name))
+                    if rel in synced:
+                        continue
+                    base, ext = path.splitext(rel)
+                    if ext in self.SIBLINGS and base in synced and self._unchanged(path.join(current, base), path.join(release, base)):
+                        self._check(path.dirname(path.join(release, rel)))
+                        link(path.join(current, rel), path.join(release, rel))
+                        linked += 1
+                    else:
+                        deleted += 1
+        return linked, copied, deleted
+
+    def _unchanged(self, current, release):
+        """
+        Check if a release file is a hard link to the current release's file.
+        """
+        try:
+            current_st = lstat(current)
+            release_st = lstat(release)
+        except OSError:
+            return False
+        return (current_st.st_dev, current_st.st_ino) == (release_st.st_dev, release_st.st_ino)
+
+    def sync(self, source, site_base, checksum=False, keep=3, owner='root', group='nginx', mode=0o750, prepare=None):
+        """
+        Sync a source into a new release directory and atomically switch the
+        site's 'public' symbolic link to it. An optional prepare callback is
+        run on the release directory before it is activated.
+        """
+        self._uid  = getpwnam(owner).pw_uid if owner else -1
+        self._gid  = getgrnam(group).gr_gid if group else -1
+        self._mode = mode
+        self._dirs = set()
+        self._root = path.realpath(site_base)
+
+        # Release directories / public link
+        releases = '{0}/releases'.format(site_base)
+        public   = '{0}/public'.format(site_base)
+        self._mkdir(releases)
+
+        # Move an existing document root into the first release
+        if path.isdir(public) and not path.islink(public):
+            initial = '{0}/{1}'.format(releases, time.strftime('%Y%m%d%H%M%S', time.localtime(lstat(public).st_mtime)))
+            rename(public, initial)
+            symlink(path.relpath(initial, site_base), public)
+            self.feedback.info('Moved document root into release: {0}'.format(initial))
+        current = path.realpath(public) if path.islink(public) else None
+
+        # New release directory
+        release_id = time.strftime('%Y%m%d%H%M%S')
+        release    = '{0}/{1}'.format(releases, release_id)
+        suffix     = 1
+        while path.exists(release):
+            release = '{0}/{1}.{2}'.format(releases, release_id, suffix)
+            suffix += 1
+
+        # Delta sync from a local directory, anything else is deployed in full
+        if not self.is_remote(source) and path.isdir(source):
+            linked, copied, deleted = self._sync_tree(source, current, release, checksum)
+            self.feedback.success('Synced release {0}: {1} unchanged, {2} copied, {3} removed'.format(release, linked, copied, deleted))
+        else:
+            self.deploy(source, release, owner=owner, group=group, mode=mode)
+
+        # Finish the release before it goes live
+        if prepare:
+            prepare(release)
+
+        # Atomically switch the public link to the new release
+        tmp_link = '{0}/.public.{1}'.format(site_base, getpid())
+        if path.lexists(tmp_link):
+            unlink(tmp_link)
+        symlink(path.relpath(release, site_base), tmp_link)
+        rename(tmp_link, public)
+        self.feedback.success('Activated release -> {0}'.format(release))
+
+        # Remove old releases
+        for name in sorted(listdir(releases))[:-keep] if keep else []:
+            old = '{0}/{1}'.format(releases, name)
+            if old != release and old != current:
+                shutil.rmtree(old)
+                self.feedback.info('Removed old release: {0}'.format(old))
+        return release
@@ -0,0 +1,245 @@
+import re
+import atexit
+import shutil
+import hashlib
+from tempfile import mkdtemp
+from subprocess import Popen, PIPE
+from os import path, walk, readlink, symlink, unlink, makedirs, stat
+
+# NGUtil Libraries
+from .common import _NGUtilCommon
+from .nginx import _NGUtilNginx
+
+class _NGUtilStage(_NGUtilCommon):
+    """
+    Class object for staging and validating NGINX configuration changes.
+    """
+
+    # Directives referencing files outside the configuration root
+    REFERENCES = re.compile(r'^\s*(?:ssl_certificate|ssl_certificate_key|ssl_trusted_certificate|ssl_client_certificate|ssl_dhparam|ssl_stapling_file|fastcgi_cache_path|proxy_cache_path)\s+([^\s;]+)', re.M)
+    def __init__(self, root='/etc/nginx', cache='/root/.ngutil/validated'):
+        super(_NGUtilStage, self).__init__()
+
+        # Live configuration root / validated tree hashes
+        self.root  = root
+        self.cache = cache
+
+        # Staged copy of the configuration root / pending changes
+        self.stage = None
+        self._ops  = []
+
+    def _to_stage(self, value):
+        """
+        Point live configuration paths at the staged copy.
+        """
+        if isinstance(value, bytes):
+            return value.replace('{0}/'.format(self.root).encode('utf-8'), '{0}/'.format(self.stage).encode('utf-8'))
+        return value.replace('{0}/'.format(self.root), '{0}/'.format(self.stage))
+
+    def _to_live(self, value):
+        """
+        Point staged configuration paths back at the live root.
+        """
+        if isinstance(value, bytes):
+            return value.replace('{0}/'.format(self.stage).encode('utf-8'), '{0}/'.format(self.root).encode('utf-8'))
+        return value.replace('{0}/'.format(self.stage), '{0}/'.format(self.root))
+
+    def _staged(self, live_path):
+        """
+        Map a live file path to its staged copy.
+        """
+        if not live_path.startswith('{0}/'.format(self.root)):
+            self.die('Cannot stage \'{0}\', not under \'{1}\''.format(live_path, self.root))
+        return self._to_stage(live_path)
+
+    def begin(self):
+        """
+        Create a staged copy of the live configuration root.
+        """
+        if self.stage:
+            return self.stage
+        self.stage = mkdtemp(prefix='ngutil-nginx-')
+        self._ops  = []
+        atexit.register(self.rollback)
+
+        # Copy the configuration tree, rewriting paths into the stage
+        for dirpath, dirnames, filenames in walk(self.root):
+            staged_dir = self._to_stage('{0}/'.format(dirpath))
+            if not path.isdir(staged_dir):
+                makedirs(staged_dir)
+            for name in dirnames + filenames:
+                live_path   = path.join(dirpath, name)
+                staged_path = path.join(staged_dir, name)
+                if path.islink(live_path):
+                    symlink(self._to_stage(readlink(live_path)), staged_path)
+                elif path.isfile(live_path):
+                    fh = open(live_path, 'rb')
+                    contents = fh.read()
+                    fh.close()
+                    fh = open(staged_path, 'wb')
+                    fh.write(self._to_stage(contents))
+                    fh.close()
+        self.feedback.info('Staged NGINX configuration: {0} -> {1}'.format(self.root, self.stage))
+        return self.stage
+
+    def write(self, live_path, contents, owner='root', mode=0o644):
+        """
+        Stage a file write. Returns True if the contents differ from the live file.
+        """
+        self.begin()
+        if not isinstance(contents, bytes):
+            contents = contents.encode('utf-8')
+        if not self.write_file(self._staged(live_path), self._to_stage(contents), owner=owner, mode=mode):
+            return False
+        self._ops.append(('write', live_path, contents, owner, mode))
+        return True
+
+    def symlink(self, source, link):
+        """
+        Stage a new symbolic link.
+        """
+        self.begin()
+        staged_link = self._staged(link)
+        if path.lexists(staged_link):
+            return False
+        symlink(self._to_stage(source), staged_link)
+        self._ops.append(('symlink', source, link))
+        return True
+
+    def unlink(self, link):
+        """
+        Stage the removal of a file or link.
+        """
+        self.begin()
+        staged_link = self._staged(link)
+        if not path.lexists(staged_link):
+            return False
+        unlink(staged_link)
+        self._ops.append(('unlink', link))
+        return True
+
+    def _hash_tree(self):
+        """
+        Hash the staged tree as it will appear once committed.
+        """
+        digest = hashlib.sha256()
+        for dirpath, dirnames, filenames in walk(self.stage):
+            dirnames.sort()
+            for name in sorted(filenames + [d for d in dirnames if path.islink(path.join(dirpath, d))]):
+                staged_path = path.join(dirpath, name)
+                digest.update(self._to_live(staged_path).encode('utf-8'))
+                if path.islink(staged_path):
+                    digest.update(b'->')
+                    digest.update(self._to_live(readlink(staged_path)).encode('utf-8'))
+                else:
+                    fh = open(staged_path, 'rb')
+                    digest.update(self._to_live(fh.read()))
+                    fh.close()
+                digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _validated(self):
+        """
+        Return the list of previously validated tree hashes.
+        """
+        if not path.isfile(self.cache):
+            return []
+        fh = open(self.cache, 'r')
+        hashes = fh.read().split()
+        fh.close()
+        return hashes
+
+    def _hash_environment(self):
+        """
+        Hash what 'nginx -t' checks beyond the staged tree: the NGINX build
+        and the certificates / cache directories the configuration references.
+        """
+        digest = hashlib.sha256(_NGUtilNginx().fingerprint().encode('utf-8'))
+        references = set()
+        for dirpath, dirnames, filenames in walk(self.stage):
+            for name in filenames:
+                staged_path = path.join(dirpath, name)
+                if path.islink(staged_path):
+                    continue
+                fh = open(staged_path, 'rb')
+                contents = self._to_live(fh.read()).decode('utf-8', 'replace')
+                fh.close()
+                references.update(self.REFERENCES.findall(contents))
+
+        # Certificates by content, directories by modification time
+        for reference in sorted(references):
+            digest.update(reference.encode('utf-8'))
+            if path.isfile(reference):
+                digest.update(self._hash_file(reference).encode('utf-8'))
+            elif path.isdir(reference):
+                digest.update(str(stat(reference).st_mtime).encode('utf-8'))
+            else:
+                digest.update(b'missing')
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def validate(self):
+        """
+        Run 'nginx -t' against the staged configuration, unless the same tree
+        has already been validated with the same NGINX build and referenced
+        files.
+        """
+        self.begin()
+        tree_hash = hashlib.sha256('{0}:{1}'.format(self._hash_tree(), self._hash_environment()).encode('utf-8')).hexdigest()
+        validated = self._validated()
+        if tree_hash in validated:
+            self.feedback.info('NGINX configuration already validated, skipping check...')
+            return True
+
+        # Test the staged configuration
+        try:
+            proc = Popen(['nginx', '-t', '-c', '{0}/nginx.conf'.format(self.stage)], stdout=PIPE, stderr=PIPE)
+            out, err = proc.communicate()
+        except OSError as e:
+            self.rollback()
+            self.die('Failed to run \'nginx -t\', is NGINX installed? ERROR={0}'.format(str(e)))
+        if not proc.returncode == 0:
+            self.feedback.error('NGINX configuration test failed: {0}'.format(self._to_live(err).rstrip()))
+            return False
+
+        # Remember the validated tree, keeping the most recent entries
+        self.write_file(self.cache, '\n'.join((validated + [tree_hash])[-50:]) + '\n', mode=0o600)
+        self.feedback.success('Validated staged NGINX configuration')
+        return True
+
+    def commit(self):
+        """
+        Validate and apply staged changes to the live configuration. Returns
+        True if the live configuration changed.
+        """
+        if not self._ops:
+            self.rollback()
+            return False
+
+        # Discard the staged changes if the configuration is invalid
+        if not self.validate():
+            self.rollback()
+            self.die('Invalid NGINX configuration, staged changes discarded...')
+
+        # Apply each change to the live configuration
+        for op in self._ops:
+            if op[0] == 'write':
+                self.write_file(op[1], op[2], owner=op[3], mode=op[4])
+            elif op[0] == 'symlink':
+                if not path.lexists(op[2]):
+                    symlink(op[1], op[2])
+            elif op[0] == 'unlink':
+                if path.lexists(op[1]):
+                    unlink(op[1])
+        self.feedback.success('Applied {0} staged NGINX configuration change(s)'.format(len(self._ops)))
+        self.rollback()
+        return True
+
+    def rollback(self):
+        """
+        Discard the staged copy and any pending changes.
+        """
+        if self.stage and path.isdir(self.stage):
+            shutil.rmtree(self.stage)
+        self.stage = None
+        self._ops  = []
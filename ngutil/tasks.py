@@ -0,0 +1,121 @@
+import time
+from multiprocessing.pool import ThreadPool
+
+# Python 2/3 queue module
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+# NGUtil Libraries
+from .common import _NGUtilCommon
+
+class _NGUtilTasks(_NGUtilCommon):
+    """
+    Class object for running a graph of dependent tasks in a thread pool.
+    """
+    def __init__(self, threads=4):
+        super(_NGUtilTasks, self).__init__()
+
+        # Worker threads
+        self.threads = threads
+
+        # Task order / definitions / run times
+        self._order  = []
+        self._tasks  = {}
+        self.timings = {}
+
+    def add(self, name, method, requires=None):
+        """
+        Add a task which runs once all required tasks have completed.
+        """
+        if name in self._tasks:
+            self.die('Task \'{0}\' already defined'.format(name))
+        self._order.append(name)
+        self._tasks[name] = {
+            'method':   method,
+            'requires': list(requires or [])
+        }
+
+    def _check(self):
+        """
+        Make sure all dependencies exist and the graph has no cycles.
+        """
+        for name in self._order:
+            for required in self._tasks[name]['requires']:
+                if not required in self._tasks:
+                    self.die('Task \'{0}\' requires unknown task \'{1}\''.format(name, required))
+
+        # Resolve tasks in dependency order
+        resolved = []
+        while len(resolved) < len(self._order):
+            ready = [n for n in self._order if not n in resolved and not [r for r in self._tasks[n]['requires'] if not r in resolved]]
+            if not ready:
+                self.die('Circular task dependencies: {0}'.format(', '.join([n for n in self._order if not n in resolved])))
+            resolved.extend(ready)
+
+    def _run_task(self, name, results):
+        """
+        Run a single task, reporting the result on the results queue.
+        """
+        start = time.time()
+        try:
+            self._tasks[name]['method']()
+            results.put((name, time.time() - start, None))
+
+        # Includes SystemExit raised by die()
+        except BaseException as e:
+            results.put((name, time.time() - start, e))
+
+    def run(self):
+        """
+        Run all tasks, starting each as soon as its dependencies complete.
+        """
+        self._check()
+        results = Queue()
+        pool    = ThreadPool(self.threads)
+        start   = time.time()
+
+        # Completed / running tasks, first failure
+        done    = []
+        running = []
+        failed  = None
+        try:
+            while len(done) < len(self._order):
+
+                # Start every task whose dependencies are complete
+                if not failed:
+                    for name in self._order:
+                        if name in done or name in running:
+                            continue
+                        if [r for r in self._tasks[name]['requires'] if not r in done]:
+                            continue
+                        running.append(name)
+                        pool.apply_async(self._run_task, (name, results))
+
+                # Stop once running tasks finish after a failure
+                if not running:
+                    break
+
+                # Wait for the next task to finish
+                name, elapsed, error = results.get()
+                running.remove(name)
+                done.append(name)
+                self.timings[name] = elapsed
+                if error and not failed:
+                    failed = (name, error)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Report the time spent in each step
+        self.timings['total'] = time.time() - start
+        self.feedback.block(['{0:<20} {1:>8.2f}s{2}'.format(name, self.timings[name], ' (failed)' if failed and failed[0] == name else '')
+            for name in self._order if name in self.timings] + ['{0:<20} {1:>8.2f}s'.format('total', self.timings['total'])], 'TIMINGS')
+
+        # Propagate the first failure
+        if failed:
+            if isinstance(failed[1], SystemExit):
+                raise failed[1]
+            self.die('Task \'{0}\' failed: {1}'.format(failed[0], str(failed[1])))
+        return self.timings
@@ -1,13 +1,51 @@
-from pwd import getpwnam
-from os import path, makedirs, chown, chmod
+import re
+from os import path, stat
 
 # NGUtil Libraries
 from .common import _NGUtilCommon
 
+class _NGUtilCompiledTemplate(object):
+    """
+    Template parsed into literal chunks and placeholder slots.
+    """
+    
+    # Placeholder syntax: {{VAR}}
+    PLACEHOLDER = re.compile(r'\{\{([A-Za-z0-9_]+)\}\}')
+    
+    def __init__(self, contents):
+        
+        # Literal chunks / placeholder slots as (index, name)
+        self.chunks = []
+        self.slots  = []
+        
+        # Split the template, placeholder names land on odd indexes
+        for i, chunk in enumerate(self.PLACEHOLDER.split(contents)):
+            if i % 2:
+                self.slots.append((len(self.chunks), chunk))
+                self.chunks.append(None)
+            elif chunk:
+                self.chunks.append(chunk)
+                
+        # Unique placeholder names
+        self.placeholders = set([name for index, name in self.slots])
+        
+    def render(self, variables):
+        """
+        Render the template in a single pass.
+        """
+        parts = list(self.chunks)
+        for index, name in self.slots:
+            parts[index] = str(variables[name])
+        return ''.join(parts)
+
 class _NGUtilTemplates(_NGUtilCommon):
     """
     Class for handling loading and updating template files.
     """
+    
+    # Compiled templates shared by all instances: {path: (mtime, compiled)}
+    _cache = {}
+    
     def __init__(self):
         super(_NGUtilTemplates, self).__init__()
         
@@ -15,21 +53,28 @@ class _NGUtilTemplates(_NGUtilCommon):
         self.active = None
         self.target = None
         
-        # Template contents
-        self.contents = None
+        # Compiled template / substitution variables
+        self.compiled  = None
+        self.variables = {}
         
-    def _mkpath(self, file):
+    @classmethod
+    def _compile(cls, file):
         """
-        Make sure the path to a file exists.
+        Load a compiled template, using the cache unless the file has changed.
         """
+        mtime  = stat(file).st_mtime
+        cached = cls._cache.get(file)
+        if cached and cached[0] == mtime:
+            return cached[1]
         
-        # Target directory
-        target_dir = path.dirname(file)
+        # Parse the template file
+        fh = open(file, 'r')
+        compiled = _NGUtilCompiledTemplate(fh.read())
+        fh.close()
         
-        # Make sure the directory exists
-        if not path.isdir(target_dir):
-            makedirs(target_dir)
-            self.feedback.success('Created path -> {0}'.format(target_dir))
+        # Cache the compiled template
+        cls._cache[file] = (mtime, compiled)
+        return compiled
         
     def setup(self, template_id, target_file):
         """
@@ -43,35 +88,52 @@ class _NGUtilTemplates(_NGUtilCommon):
         self.active = template_id
         self.target = target_file
         
-        # Read the template into memory
-        fh = open(self._TEMPLATES[template_id], 'r')
-        self.contents = fh.read()
-        fh.close()
+        # Load the compiled template
+        self.compiled  = self._compile(self._TEMPLATES[template_id])
+        self.variables = {}
         
     def setvars(self, args):
         """
         Set template substitution variables.
         """
-        for k,v in args.iteritems():
-            self.contents = self.contents.replace('{{{{{0}}}}}'.format(k), str(v))
-            self.feedback.success('Updated template variable \'{0}\'-> {1}'.format(k,v))
+        self.variables.update(args)
+        self.feedback.success('Updated template variables: {0}'.format(', '.join(sorted(args.keys()))))
+        
+    def render(self):
+        """
+        Render the active template with the current variables.
+        """
+        
+        # Placeholders without a value / values without a placeholder
+        missing = self.compiled.placeholders.difference(self.variables.keys())
+        unknown = set(self.variables.keys()).difference(self.compiled.placeholders)
+        
+        # Every placeholder must be set, and every variable must be used
+        if missing:
+            self.die('Cannot render template \'{0}\', missing variable(s): {1}'.format(self.active, ', '.join(sorted(missing))))
+        if unknown:
+            self.die('Cannot render template \'{0}\', unknown variable(s): {1}'.format(self.active, ', '.join(sorted(unknown))))
+        return self.compiled.render(self.variables)
             
-    def deploy(self, owner='root', mode=644, overwrite=False):
+    def deploy(self, owner='root', mode=0o644, overwrite=False, stage=None):
         """
-        Deploy the template file.
+        Deploy the template file, optionally to a configuration stage. Returns
+        True if the target was changed.
         """
         if path.isfile(self.target) and not overwrite:
             self.die('Cannot deploy template file, target \'{0}\' already exists.'.format(self.target))
             
-        # Make sure the path to the file exists
-        self._mkpath(self.target)
-        
-        # Create the file
-        fh = open(self.target, 'w')
-        fh.write(self.contents)
-        fh.close()
-        
-        # Set permissions
-        chown(self.target, getpwnam(owner).pw_uid, getpwnam(owner).pw_gid)
-        chmod(self.target, mode)
-        self.feedback.success('Deployed template -> {0}'.format(self.target))
\ No newline at end of file
+        # Stage the rendered template for validation
+        if stage:
+            if not stage.write(self.target, self.render(), owner=owner, mode=mode):
+                self.feedback.info('Template unchanged, skipping -> {0}'.format(self.target))
+                return False
+            self.feedback.success('Staged template -> {0}'.format(self.target))
+            return True
+            
+        # Atomically write the rendered template if it changed
+        if not self.write_file(self.target, self.render(), owner=owner, mode=mode):
+            self.feedback.info('Template unchanged, skipping -> {0}'.format(self.target))
+            return False
+        self.feedback.success('Deployed template -> {0}'.format(self.target))
+        return True
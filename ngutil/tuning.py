@@ -0,0 +1,282 @@
+import os
+import re
+import glob
+import resource
+
+# NGUtil Libraries
+from .common import _NGUtilCommon
+
+class _NGUtilTuning(_NGUtilCommon):
+    """
+    Class object for sizing services from the available hardware resources,
+    respecting CPU affinity and cgroup limits.
+    """
+
+    # PHP-FPM worker size assumed when no workers are running
+    PHP_RSS = 40 * 1048576
+
+    # PHP-FPM pool profiles
+    PROFILES = ['latency', 'density']
+
+    def __init__(self, proc='/proc', sys='/sys', cgroup='/sys/fs/cgroup'):
+        super(_NGUtilTuning, self).__init__()
+
+        # Kernel interfaces
+        self.proc   = proc
+        self.sys    = sys
+        self.cgroup = cgroup
+
+        # Detected values
+        self._facts = {}
+
+    def _read(self, file, default=None):
+        """
+        Read a single value from a kernel interface file.
+        """
+        try:
+            fh = open(file, 'r')
+            try:
+                return fh.read().strip()
+            finally:
+                fh.close()
+        except (IOError, OSError):
+            return default
+
+    def _parse_cpulist(self, cpulist):
+        """
+        Expand a CPU list such as '0-3,8,10-11'.
+        """
+        cpus = []
+        for part in (cpulist or '').split(','):
+            part = part.strip()
+            if '-' in part:
+                start, end = part.split('-', 1)
+                cpus.extend(range(int(start), int(end) + 1))
+            elif part:
+                cpus.append(int(part))
+        return sorted(set(cpus))
+
+    def _cgroup_paths(self, controller):
+        """
+        Candidate directories for a cgroup controller of this process, for
+        both cgroup v1 and the unified v2 hierarchy.
+        """
+        paths = []
+        for line in (self._read('{0}/self/cgroup'.format(self.proc)) or '').splitlines():
+            fields = line.split(':', 2)
+            if len(fields) != 3:
+                continue
+            if fields[1] == '':
+                paths.append('{0}{1}'.format(self.cgroup, fields[2]))
+            elif controller in fields[1].split(','):
+                for mount in [controller, fields[1]]:
+                    paths.append('{0}/{1}{2}'.format(self.cgroup, mount, fields[2]))
+
+        # Namespaced containers see their own cgroup at the mount root
+        return [p.rstrip('/') for p in paths] + [self.cgroup, '{0}/{1}'.format(self.cgroup, controller)]
+
+    def affinity(self):
+        """
+        CPUs this process is allowed to run on.
+        """
+        if 'affinity' in self._facts:
+            return self._facts['affinity']
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            match = re.search(r'^Cpus_allowed_list:\s*(\S+)', self._read('{0}/self/status'.format(self.proc), ''), re.M)
+            cpus  = self._parse_cpulist(match.group(1)) if match else range(os.sysconf('SC_NPROCESSORS_ONLN'))
+        self._facts['affinity'] = list(cpus)
+        return self._facts['affinity']
+
+    def cpu_quota(self):
+        """
+        CPU limit imposed by a cgroup CFS quota, or None if unlimited.
+        """
+        if 'cpu_quota' in self._facts:
+            return self._facts['cpu_quota']
+        quota = None
+        for base in self._cgroup_paths('cpu'):
+
+            # cgroup v2: '<quota> <period>' or 'max <period>'
+            cpu_max = self._read('{0}/cpu.max'.format(base))
+            if cpu_max:
+                fields = cpu_max.split()
+                if fields[0] != 'max':
+                    quota = float(fields[0]) / float(fields[1])
+                break
+
+            # cgroup v1: quota of -1 is unlimited
+            cfs_quota = self._read('{0}/cpu.cfs_quota_us'.format(base))
+            if cfs_quota:
+                if int(cfs_quota) > 0:
+                    quota = float(cfs_quota) / float(self._read('{0}/cpu.cfs_period_us'.format(base), '100000'))
+                break
+        self._facts['cpu_quota'] = quota
+        return quota
+
+    def cpus(self):
+        """
+        Number of CPUs usable by this host or container.
+        """
+        cpus  = len(self.affinity())
+        quota = self.cpu_quota()
+        if quota:
+            cpus = min(cpus, max(1, int(quota + 0.5)))
+        return max(1, cpus)
+
+    def numa_nodes(self):
+        """
+        Allowed CPUs grouped by NUMA node.
+        """
+        allowed = set(self.affinity())
+        nodes   = []
+        for node in sorted(glob.glob('{0}/devices/system/node/node[0-9]*'.format(self.sys)), key=lambda n: int(re.sub(r'^.*node', '', n))):
+            cpus = [c for c in self._parse_cpulist(self._read('{0}/cpulist'.format(node))) if c in allowed]
+            if cpus:
+                nodes.append(cpus)
+        return nodes or [sorted(allowed)]
+
+    def memory(self):
+        """
+        Usable memory in bytes, the smaller of physical memory and any cgroup
+        memory limit.
+        """
+        if 'memory' in self._facts:
+            return self._facts['memory']
+        match  = re.search(r'^MemTotal:\s*([0-9]+)\s*kB', self._read('{0}/meminfo'.format(self.proc), ''), re.M)
+        memory = int(match.group(1)) * 1024 if match else 0
+        for base in self._cgroup_paths('memory'):
+            limit = self._read('{0}/memory.max'.format(base)) or self._read('{0}/memory.limit_in_bytes'.format(base))
+            if limit:
+                if limit.isdigit() and (not memory or int(limit) < memory):
+                    memory = int(limit)
+                break
+        self._facts['memory'] = memory
+        return memory
+
+    def nofile(self):
+        """
+        Open file limit available to each NGINX worker.
+        """
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        nr_open    = int(self._read('{0}/sys/fs/nr_open'.format(self.proc), '1048576'))
+        if hard == resource.RLIM_INFINITY or hard > nr_open:
+            hard = nr_open
+
+        # Share the system wide limit between workers
+        file_max = int(self._read('{0}/sys/fs/file-max'.format(self.proc), str(hard)))
+        return max(1024, min(hard, file_max // self.cpus(), 65536))
+
+    def cpu_affinity(self, workers):
+        """
+        CPU affinity masks binding each worker to its own CPU, spreading
+        workers across NUMA nodes.
+        """
+        nodes = [list(n) for n in self.numa_nodes()]
+        cpus  = []
+        while len(cpus) < workers and [n for n in nodes if n]:
+            for node in nodes:
+                if node and len(cpus) < workers:
+                    cpus.append(node.pop(0))
+        width = max(self.affinity()) + 1
+        return ' '.join([''.join(['1' if c == cpu else '0' for c in reversed(range(width))]) for cpu in cpus])
+
+    def nginx(self):
+        """
+        NGINX worker settings for this host.
+        """
+        workers = self.cpus()
+        nofile  = self.nofile()
+
+        # Each proxied request holds a client and an upstream descriptor, and
+        # connection buffers should stay within a quarter of memory
+        connections = nofile // 2
+        if self.memory():
+            connections = min(connections, self.memory() // 4 // (workers * 16384))
+        settings = {
+            'WORKERPROCESSES':    str(workers),
+            'WORKERCPUAFFINITY':  self.cpu_affinity(workers),
+            'WORKERRLIMITNOFILE': str(nofile),
+            'WORKERCONNECTION':   str(max(512, connections)),
+
+            # Few workers drain the accept queue in one go
+            'MULTIACCEPT':        'on' if workers <= 2 else 'off',
+
+            # One shared TLS session cache, 1MB holds about 4000 sessions
+            'SSLSESSIONCACHE':    '{0}m'.format(max(10, min(self.memory() // 1048576 // 100, 100)))
+        }
+        self.feedback.info('NGINX tuning: cpus={0} (affinity={1}, quota={2}), memory={3}MB, numa_nodes={4}, nofile={5}'.format(
+            workers, len(self.affinity()), self.cpu_quota() or 'none', self.memory() // 1048576, len(self.numa_nodes()), nofile
+        ))
+        return settings
+
+    def _process_memory(self, pid):
+        """
+        Memory used by a process in bytes, preferring the proportional set
+        size so shared pages (i.e. the opcache) are not counted per worker.
+        """
+        for file, field in [('smaps_rollup', 'Pss'), ('status', 'VmRSS')]:
+            match = re.search(r'^{0}:\s*([0-9]+)\s*kB'.format(field), self._read('{0}/{1}/{2}'.format(self.proc, pid, file), ''), re.M)
+            if match:
+                return int(match.group(1)) * 1024
+        return None
+
+    def php_rss(self):
+        """
+        Average memory used by running PHP-FPM pool workers.
+        """
+        if 'php_rss' in self._facts:
+            return self._facts['php_rss']
+        samples = []
+        for pid in [p for p in os.listdir(self.proc) if p.isdigit()]:
+            cmdline = self._read('{0}/{1}/cmdline'.format(self.proc, pid), '').replace('\0', ' ')
+
+            # Workers are titled 'php-fpm: pool <name>', skip the master
+            if cmdline.startswith('php-fpm: pool '):
+                memory = self._process_memory(pid)
+                if memory:
+                    samples.append(memory)
+        self._facts['php_rss'] = (sum(samples) // len(samples)) if samples else None
+        return self._facts['php_rss']
+
+    def phpfpm(self, profile='density', pools=1):
+        """
+        PHP-FPM process manager settings for a pool, sharing memory equally
+        between pools.
+        """
+        if not profile in self.PROFILES:
+            self.die('Invalid PHP-FPM profile \'{0}\', must be one of: {1}'.format(profile, ', '.join(self.PROFILES)))
+        cpus   = self.cpus()
+        rss    = self.php_rss() or self.PHP_RSS
+        memory = self.memory() or 1073741824
+
+        # Leave room for the OS, NGINX and anything else on the host
+        budget   = (memory - max(268435456, memory // 5)) // max(1, pools)
+        children = max(2, budget // rss)
+
+        # Latency: keep workers forked, statically if the whole pool is small
+        if profile == 'latency':
+            pm = 'static' if children <= cpus * 4 else 'dynamic'
+            max_requests = 1000
+
+        # Density: only fork workers while requests are arriving
+        else:
+            pm = 'ondemand'
+            max_requests = 200
+
+        # Spare servers, only used by the dynamic process manager
+        min_spare = max(1, min(cpus, children // 4))
+        max_spare = max(min_spare + 1, min(cpus * 3, children // 2))
+        settings = {
+            'PM':                pm,
+            'PMMAXCHILDREN':     str(children),
+            'PMSTARTSERVERS':    str(min(children, max(min_spare, min(cpus * 2, max_spare)))),
+            'PMMINSPARESERVERS': str(min_spare),
+            'PMMAXSPARESERVERS': str(max_spare),
+            'PMMAXREQUESTS':     str(max_requests)
+        }
+        self.feedback.info('PHP-FPM tuning: profile={0}, pm={1}, max_children={2}, worker_rss={3}MB ({4}), budget={5}MB'.format(
+            profile, pm, children, rss // 1048576, 'measured' if self.php_rss() else 'default', budget // 1048576
+        ))
+        return settings
@@ -0,0 +1,112 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+# Python 2/3 HTTP server
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from ngutil.cache import _NGUtilCache
+
+# Artifact served by the stand-in server
+BODY = b'ngutil-artifact' * 1024
+ETAG = '"{0}"'.format(hashlib.sha256(BODY).hexdigest())
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Serve a single artifact, answering conditional requests with a 304.
+    """
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root   = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/artifact.rpm'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+        _NGUtilCache._verified.clear()
+
+    def _cache(self, offline=False):
+        return _NGUtilCache(root=self.root, offline=offline)
+
+    def _corrupt(self, cached):
+        fh = open(cached, 'wb')
+        fh.write(BODY[:100])
+        fh.close()
+
+    def _read(self, cached):
+        fh = open(cached, 'rb')
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def test_revalidate_not_modified(self):
+        cached = self._cache().fetch(self.url)
+        self.assertEqual(self._cache().fetch(self.url), cached)
+        self.assertEqual(self.server.requests, [None, ETAG])
+        self.assertEqual(self._read(cached), BODY)
+
+    def test_revalidate_corrupt_object(self):
+        cached = self._cache().fetch(self.url)
+        self._corrupt(cached)
+        self.assertEqual(self._cache().fetch(self.url), cached)
+        self.assertEqual(self.server.requests, [None, None])
+        self.assertEqual(self._read(cached), BODY)
+
+    def test_offline(self):
+        cached = self._cache().fetch(self.url)
+        self.assertEqual(self._cache(offline=True).fetch(self.url), cached)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_offline_corrupt_object(self):
+        cached = self._cache().fetch(self.url)
+        self._corrupt(cached)
+        self.assertRaises(SystemExit, self._cache(offline=True).fetch, self.url)
+        self.assertFalse(os.path.exists(cached))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_offline_not_cached(self):
+        self.assertRaises(SystemExit, self._cache(offline=True).fetch, self.url)
+        self.assertEqual(self.server.requests, [])
+
+    def test_pinned(self):
+        sha256 = hashlib.sha256(BODY).hexdigest()
+        cached = self._cache().fetch(self.url, sha256=sha256)
+        self.assertEqual(self._cache().fetch(self.url, sha256=sha256), cached)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_checksum_mismatch(self):
+        self.assertRaises(SystemExit, self._cache().fetch, self.url, sha256='0' * 64)
+        self.assertEqual(os.listdir('{0}/objects'.format(self.root)), [])
+        self.assertIsNone(self._cache().lookup(self.url))
+
+if __name__ == '__main__':
+    unittest.main()
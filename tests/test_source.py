@@ -0,0 +1,79 @@
+import os
+import io
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from ngutil.source import _NGUtilSource
+
+class SourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root   = tempfile.mkdtemp()
+        self.target = os.path.join(self.root, 'site', 'public')
+        os.makedirs(self.target)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _archive(self, members):
+        """
+        Build a tar archive from (name, link target or file contents) pairs.
+        """
+        archive = os.path.join(self.root, 'source.tar')
+        tar     = tarfile.open(archive, 'w')
+        for name, value in members:
+            info = tarfile.TarInfo(name)
+            if isinstance(value, bytes):
+                info.size = len(value)
+                tar.addfile(info, io.BytesIO(value))
+            else:
+                info.type     = tarfile.SYMTYPE
+                info.linkname = value
+                tar.addfile(info)
+        tar.close()
+        return archive
+
+    def _deploy(self, archive):
+        return _NGUtilSource(cache=object()).deploy(archive, self.target, owner=None, group=None)
+
+    def test_chained_links_stay_inside(self):
+        archive = self._archive([('a', '.'), ('a/b', '..'), ('a/b/evil.txt', b'evil')])
+        try:
+            self._deploy(archive)
+        except SystemExit:
+            pass
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'site', 'evil.txt')))
+        self.assertFalse(os.path.islink(os.path.join(self.target, 'b')))
+
+    def test_existing_link_outside(self):
+        outside = os.path.join(self.root, 'outside')
+        os.makedirs(outside)
+        os.symlink(outside, os.path.join(self.target, 'x'))
+        self.assertRaises(SystemExit, self._deploy, self._archive([('x/evil.txt', b'evil')]))
+        self.assertEqual(os.listdir(outside), [])
+
+    def test_links_inside(self):
+        self._deploy(self._archive([('dir/index.html', b'index'), ('link', 'dir')]))
+        self.assertEqual(os.readlink(os.path.join(self.target, 'link')), 'dir')
+        self.assertTrue(os.path.isfile(os.path.join(self.target, 'link', 'index.html')))
+
+    def test_deploy_keeps_mtime(self):
+        source = os.path.join(self.root, 'source')
+        os.makedirs(source)
+        fh = open(os.path.join(source, 'index.html'), 'w')
+        fh.write('index')
+        fh.close()
+        os.utime(os.path.join(source, 'index.html'), (1000000000, 1000000000))
+        _NGUtilSource(cache=object()).deploy(source, self.target, owner=None, group=None)
+        self.assertEqual(int(os.stat(os.path.join(self.target, 'index.html')).st_mtime), 1000000000)
+
+        # The first sync after a deploy links the unchanged file
+        release = _NGUtilSource(cache=object()).sync(source, os.path.dirname(self.target), owner=None, group=None)
+        previous = [r for r in os.listdir(os.path.dirname(release)) if os.path.join(os.path.dirname(release), r) != release][0]
+        self.assertEqual(os.stat(os.path.join(release, 'index.html')).st_ino,
+                         os.stat(os.path.join(os.path.dirname(release), previous, 'index.html')).st_ino)
+
+if __name__ == '__main__':
+    unittest.main()